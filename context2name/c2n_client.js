@@ -141,7 +141,33 @@ function writeSequences(sequences, outFile, fname, mode) {
     }
 }
 
-function recover(args, ast, testcases, scopes) {
+// The server speaks HTTP/1.1. The requests run in a long-lived worker process of
+// sync-request, whose global HTTP agent (keep-alive by default since Node 19)
+// reuses the connection to the server across files
+var KEEP_ALIVE = { 'Connection' : 'keep-alive' };
+
+function sendTestcases(args, testcases) {
+    // Returns the server's result for the testcases of one file, or null if the request failed
+    var response = syncrequest('POST', 'http://' + args.ip + ":" + args.port,
+                { json : { 'tests' : testcases}, headers : KEEP_ALIVE });
+
+    if (response.statusCode === 200)
+        return JSON.parse(response.body.toString('utf-8'));
+    return null;
+}
+
+function sendBatch(args, files) {
+    // files maps file ids to their testcases. Returns the results of the files,
+    // keyed by the same ids, or null if the request failed
+    var response = syncrequest('POST', 'http://' + args.ip + ":" + args.port + "/batch",
+                { json : { 'files' : files}, headers : KEEP_ALIVE });
+
+    if (response.statusCode === 200)
+        return JSON.parse(response.body.toString('utf-8'));
+    return null;
+}
+
+function applyPredictions(args, ast, res, scopes) {
     function isOk2Rename(origName, newName, scope) {
         // Check if any of the child scopes (including this) has a use of a variable called newName, belong
         // to this or a higher scope
@@ -157,11 +183,6 @@ function recover(args, ast, testcases, scopes) {
         scope.renameVar(origName, newName);
     }
 
-    if (testcases.length === 0) {
-        // Nothing to do. The program stays as is.
-        return 0;
-    }
-
     var useStrictDirective = true;
 
     // Extract Directives
@@ -172,77 +193,80 @@ function recover(args, ast, testcases, scopes) {
         }
     }
 
-    // Send to the server
-    var response = syncrequest('POST', 'http://' + args.ip + ":" + args.port,
-                { json : { 'tests' : testcases}});
-
-    if (response.statusCode === 200) {
-        // res format : [prediction_arrays, the original names in the file, runtime]
-        // prediction arrays format : array of arrays, each inner array containing 10 tuples
-        // inner prediction tuple format : [probability, new name, index of name in the original array of names]
-        var res = JSON.parse(response.body.toString('utf-8'));
+    // res format : [prediction_arrays, the original names in the file, runtime]
+    // prediction arrays format : array of arrays, each inner array containing 10 tuples
+    // inner prediction tuple format : [probability, new name, index of name in the original array of names]
 
-        // Begin assignment of new names using a priority queue
-        var queue = new pq({ comparator: function(a, b) { return b[0] - a[0]; }});
+    // Begin assignment of new names using a priority queue
+    var queue = new pq({ comparator: function(a, b) { return b[0] - a[0]; }});
 
-        var next2use = []; // Captures the number of names tried for each variable
-        for (var i = 0; i < res[1].length; i++) {
-            queue.queue(res[0][i][0]); // the first prediction tuple for each variable
-            next2use.push(1);
-        }
+    var next2use = []; // Captures the number of names tried for each variable
+    for (var i = 0; i < res[1].length; i++) {
+        queue.queue(res[0][i][0]); // the first prediction tuple for each variable
+        next2use.push(1);
+    }
 
-        var unk_ctr = 0;
+    var unk_ctr = 0;
 
-        while (queue.length !== 0) {
-            var elem =  queue.dequeue();
-            var origIdx = elem[2];
-            var origName = res[1][origIdx].split(':')[2];
-            var newName = elem[1];
-            var curScope = scopes[origIdx];
-            if (origName === "arguments")
-                continue;
+    while (queue.length !== 0) {
+        var elem =  queue.dequeue();
+        var origIdx = elem[2];
+        var origName = res[1][origIdx].split(':')[2];
+        var newName = elem[1];
+        var curScope = scopes[origIdx];
+        if (origName === "arguments")
+            continue;
 
-            if (isOk2Rename(origName, newName, curScope)) {
-                rename(origName, newName, curScope);
-            } else {
-                if (next2use[origIdx] >= 10) { // No more predictions left
-                    if (isOk2Rename(origName, origName, curScope)) { // This is needed, it's not trivial!
-                        rename(origName, origName, curScope);
-                    } else {
-                        rename(origName, "C2N_" + unk_ctr + "_" + origName, curScope);
-                        unk_ctr += 1;
-                    }
+        if (isOk2Rename(origName, newName, curScope)) {
+            rename(origName, newName, curScope);
+        } else {
+            if (next2use[origIdx] >= 10) { // No more predictions left
+                if (isOk2Rename(origName, origName, curScope)) { // This is needed, it's not trivial!
+                    rename(origName, origName, curScope);
                 } else {
-                    queue.queue(res[0][origIdx][next2use[origIdx]]);
-                    next2use[origIdx] += 1;
-                } 
-            }
+                    rename(origName, "C2N_" + unk_ctr + "_" + origName, curScope);
+                    unk_ctr += 1;
+                }
+            } else {
+                queue.queue(res[0][origIdx][next2use[origIdx]]);
+                next2use[origIdx] += 1;
+            } 
         }
+    }
+
+    // Go over the AST and assign new names
+    estraverse.traverse(ast, {
+        enter : function(node) {
+            if (node.type === "Identifier") {
+                if (node.name && node.scope && node.scopeid) {
+                    if (node.scopeid > 0) {
+                        if (node.isFuncName)
+                            node.name = node.scope.getRenaming("$FUNC$" + node.name);
+                        else
+                            node.name = node.scope.getRenaming(node.name);
 
-        // Go over the AST and assign new names
-        estraverse.traverse(ast, {
-            enter : function(node) {
-                if (node.type === "Identifier") {
-                    if (node.name && node.scope && node.scopeid) {
-                        if (node.scopeid > 0) {
-                            if (node.isFuncName)
-                                node.name = node.scope.getRenaming("$FUNC$" + node.name);
-                            else
-                                node.name = node.scope.getRenaming(node.name);
-
-                        }
                     }
                 }
             }
-        });
+        }
+    });
+}
 
-        // All Done!
+function recover(args, ast, testcases, scopes) {
+    if (testcases.length === 0) {
+        // Nothing to do. The program stays as is.
         return 0;
+    }
 
-    } else {
+    // Send to the server
+    var res = sendTestcases(args, testcases);
+    if (res === null)
         return -1;
-    }
 
+    applyPredictions(args, ast, res, scopes);
+
+    // All Done!
+    return 0;
 }
 
 function processFile(args, fname, outFile) {
@@ -280,47 +304,56 @@ function processFile(args, fname, outFile) {
     }
 }
 
-function recoverFile(args, fname, outFile) {
-    try {
-        var code = fs.readFileSync(fname, 'utf-8');
-        var startTime = process.hrtime();
-        var ast = esprima.parse(code, {tokens: true, range: true});
-        var tokens = ast.tokens;
-        
-        // Create token2index map
-        var rangeToTokensIndexMap = new Object(null);
-        for (var i = 0; i < tokens.length; i++) {
-            rangeToTokensIndexMap[tokens[i].range + ""] = i;
-        }
+function prepareRecovery(args, fname) {
+    // Parses fname and extracts the testcases of its variables
+    var code = fs.readFileSync(fname, 'utf-8');
+    var startTime = process.hrtime();
+    var ast = esprima.parse(code, {tokens: true, range: true});
+    var tokens = ast.tokens;
+
+    // Create token2index map
+    var rangeToTokensIndexMap = new Object(null);
+    for (var i = 0; i < tokens.length; i++) {
+        rangeToTokensIndexMap[tokens[i].range + ""] = i;
+    }
 
-        // Annotate nodes with scopes
-        scoper.addScopes2AST(ast);
+    // Annotate nodes with scopes
+    scoper.addScopes2AST(ast);
 
-        // Extract Sequences
-        var sequences = extractSequences(ast, tokens, rangeToTokensIndexMap);
-        var res = writeSequences(sequences, null, fname, "recovery");
-        var testcases = res[0];
-        var scopes = res[1];
-        var isFuncs = res[2];
+    // Extract Sequences
+    var sequences = extractSequences(ast, tokens, rangeToTokensIndexMap);
+    var res = writeSequences(sequences, null, fname, "recovery");
+    return { fname : fname, ast : ast, testcases : res[0], scopes : res[1], startTime : startTime };
+}
 
-        // Start Recovery
-        recover(args, ast, testcases, scopes, isFuncs);
-        var elapsedTime = process.hrtime(startTime);
-        elapsedTime = elapsedTime[0] * 1000 + elapsedTime[1]/1000000;
-        if (args.ext)
-            args.outfile = fname.substr(0, fname.length-6) + args.ext;
-
-        if (args.outfile.endsWith(".js")) {
-            if (args.stats)
-                fs.writeFileSync(args.outfile.substr(0, args.outfile.length-3) + ".timing.stats", "Time : " + elapsedTime);
-            fs.writeFileSync(args.outfile, escodegen.generate(ast));
-        } else {
-            if (args.stats)
-                console.log("Time : " + elapsedTime);
-            console.log(escodegen.generate(ast));
-        }
+function finishRecovery(args, job) {
+    // Writes the recovered program of a prepared file
+    var fname = job.fname;
+    var elapsedTime = process.hrtime(job.startTime);
+    elapsedTime = elapsedTime[0] * 1000 + elapsedTime[1]/1000000;
+    if (args.ext)
+        args.outfile = fname.substr(0, fname.length-6) + args.ext;
+
+    if (args.outfile.endsWith(".js")) {
+        if (args.stats)
+            fs.writeFileSync(args.outfile.substr(0, args.outfile.length-3) + ".timing.stats", "Time : " + elapsedTime);
+        fs.writeFileSync(args.outfile, escodegen.generate(job.ast));
+    } else {
+        if (args.stats)
+            console.log("Time : " + elapsedTime);
+        console.log(escodegen.generate(job.ast));
+    }
 
-        console.log("[+] [" + success + "/" + failed + "] Processed file : " + fname);
+    console.log("[+] [" + success + "/" + failed + "] Processed file : " + fname);
+}
+
+function recoverFile(args, fname, outFile) {
+    try {
+        var job = prepareRecovery(args, fname);
+
+        // Start Recovery
+        recover(args, job.ast, job.testcases, job.scopes);
+        finishRecovery(args, job);
         return 0;
 
     } catch (e) {
@@ -330,6 +363,52 @@ function recoverFile(args, fname, outFile) {
     }
 }
 
+function recoverWindow(args, fnames) {
+    // Recovers a window of files with a single request to the batch endpoint
+    // of the server. The timing stats of a file include the whole request.
+    // Returns the number of files that could not be recovered
+    var jobs = [];
+    var files = new Object(null);
+    var failures = 0;
+    for (var i = 0; i < fnames.length; i++) {
+        try {
+            var job = prepareRecovery(args, fnames[i]);
+            if (job.testcases.length > 0)
+                files[jobs.length] = job.testcases;
+            jobs.push(job);
+        } catch (e) {
+            console.log("[-] [" + success + "/" + failed + "] Failed to recover file : " + fnames[i]);
+            console.error(e.stack);
+            failures += 1;
+        }
+    }
+
+    var results = {};
+    try {
+        if (Object.keys(files).length > 0)
+            results = sendBatch(args, files);
+    } catch (e) {
+        console.error(e.stack);
+        for (var j = 0; j < jobs.length; j++)
+            console.log("[-] [" + success + "/" + failed + "] Failed to recover file : " + jobs[j].fname);
+        return fnames.length;
+    }
+
+    // Files without results (the request failed) stay as they are, as with recover
+    for (var j = 0; j < jobs.length; j++) {
+        try {
+            if (results !== null && HOP(results, j + ""))
+                applyPredictions(args, jobs[j].ast, results[j], jobs[j].scopes);
+            finishRecovery(args, jobs[j]);
+        } catch (e) {
+            console.log("[-] [" + success + "/" + failed + "] Failed to recover file : " + jobs[j].fname);
+            console.error(e.stack);
+            failures += 1;
+        }
+    }
+    return failures;
+}
+
 var parser = new ArgumentParser({addHelp : true, description: 'Context2Name Client'});
 parser.addArgument(
     ['--ip'],
@@ -405,6 +484,16 @@ parser.addArgument(
     }
 );
 
+parser.addArgument(
+    ['--window'],
+    {
+        action : 'store',
+        type : 'int',
+        help : 'Number of files to recover with a single request to the server in list mode (Default : 1)',
+        defaultValue : 1
+    }
+);
+
 parser.addArgument(
     ['-t', '--training-data'],
     {
@@ -469,12 +558,31 @@ if (args.recovery) {
             input: fs.createReadStream(args.inpFile)
         });
 
+        var pending = [];
+        function recoverPending() {
+            var f = recoverWindow(args, pending);
+            success += pending.length - f;
+            failed += f;
+            pending = [];
+        }
+
         rl.on('line', function (line) {
+            if (args.window > 1) {
+                pending.push(line);
+                if (pending.length >= args.window)
+                    recoverPending();
+                return;
+            }
             var s = recoverFile(args, line, args.outfile);
             if (s == 0) success += 1;
             else failed += 1;
         });
 
+        rl.on('close', function () {
+            if (pending.length > 0)
+                recoverPending();
+        });
+
     } else {
         recoverFile(args, args.inpFile, args.outfile);
     }
@@ -1,20 +1,22 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import contextlib
+import gc
 import json
-import pickle
+import os
+import queue
+import signal
+import sys
+import threading
 import numpy as np
 import bottleneck
+from np_engine import FrozenModel, GatherEncoder, keras_dense_layer, softmax_topk
+from vocab import load_map
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
-from keras import Input
-from keras.engine import Model
-from keras.preprocessing import sequence
-from keras.utils import np_utils
-from keras.layers.core import Activation, Dense, RepeatVector
-from keras.layers.recurrent import LSTM
-from keras.models import Sequential
-from keras.models import load_model
-from keras.layers.wrappers import TimeDistributed
+# Keras is only imported when the server runs the .h5 models instead of a frozen export
 from timeit import default_timer as timer
 
 class Config:
@@ -37,81 +39,518 @@ class Config:
         self.CHUNK_SIZE1 = 25000
         self.CHUNK_SIZE2 = 20000
 
-        self.PROCESSED_FILE="vocab.pkl"
+        self.PROCESSED_FILE="vocab"  # directory of the memory-mapped vocabulary
         self.TRAINING_FILE = "training.csv"  # space separated
         self.EVAL_FILE = "eval.csv"  # space separated
         self.MODEL_FILE = "model.h5"
         self.CONFIG_FILE = "config.json"
+        self.FROZEN_DIR = "frozen"
+
+        self.TOP_K = 10
+        self.BATCH_WINDOW_MS = 5
+        self.MAX_BATCH_ROWS = 4096
+        self.ENCODER_CACHE_MB = 64
+        self.SOFTMAX_BLOCK = 4096
+        self.TOKEN_MEMO_SIZE = 1000000
+        self.MEMORY_BUDGET_MB = 512
+        self.KEEPALIVE_TIMEOUT_S = 10  # Idle keep-alive connections are closed after this long
+        self.CHUNK_ROWS = None  # Derived from MEMORY_BUDGET_MB at startup
 
 def get_models():
     return imap, omap, encoder, lstm
 
+class OneHotEncoder:
+    # Feeds token ids to the Keras encoder as dense one-hot vectors
+
+    def __init__(self, encoder, vocab_size):
+        self.encoder = encoder
+        self.vocab_size = vocab_size
+        self.units = encoder.output_shape[-1]
+
+    def predict(self, ids):
+        from keras.utils import np_utils
+        encoder_inp = np_utils.to_categorical(ids.reshape([-1]), num_classes=self.vocab_size).reshape([-1,config.N_NEIGHBORS,self.vocab_size])
+        return self.encoder.predict(encoder_inp)
+
+class TokenIds:
+    # Maps raw context tokens (including the 1ID:<scope>: prefixes) to input
+    # vocabulary ids. The id of every distinct raw token is memoized, so the
+    # prefix stripping and the vocabulary lookup run once per distinct token and
+    # a whole request is mapped with a single C-level pass over its tokens
+
+    def __init__(self, imap, max_size):
+        self.word2index = imap[1]
+        self.unk = imap[1][config.UNKNOWN_TOKEN]
+        self.pad = imap[1].get(config.PAD_TOKEN, self.unk)
+        self.max_size = max_size
+        self.memo = {}
+
+    def strip(self, x):
+        if x.startswith("1ID:-1") : x = x.split(':')[2]
+        elif x.startswith("1ID:0") : x = x.split(':')[2]
+        elif x.startswith("1ID") : x = "1ID"
+        return x
+
+    def translate(self, x):
+        return self.word2index.get(self.strip(x), self.unk)
+
+    def get(self, x):
+        i = self.memo.get(x)
+        return i if i is not None else self.translate(x)
+
+    def lookup(self, tokens):
+        memo = self.memo
+        try:
+            return np.fromiter(map(memo.__getitem__, tokens), dtype=np.int32, count=len(tokens))
+        except KeyError:
+            pass
+        if len(memo) > self.max_size:
+            memo.clear()
+        missing = list(set(tokens).difference(memo))
+        memo.update(zip(missing, self.word2index.lookup(list(map(self.strip, missing)), self.unk).tolist()))
+        return np.fromiter(map(self.get, tokens), dtype=np.int32, count=len(tokens))
+
+class Histogram:
+    # Cumulative histogram with fixed bucket upper bounds
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_json(self):
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        cumulative = np.cumsum(self.counts).tolist()
+        return {'count' : self.count, 'sum' : self.sum, 'buckets' : dict(zip(bounds, cumulative))}
+
+class Metrics:
+    # Per-stage latency histograms (milliseconds) and request counters of a
+    # server process, served as JSON on GET /metrics. Every --workers process
+    # keeps its own
+
+    LATENCY_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+    SIZE_BUCKETS = [1, 4, 16, 64, 256, 1024, 4096, 16384, 65536]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.batch_sizes = Histogram(self.SIZE_BUCKETS)
+        self.request_sizes = Histogram(self.SIZE_BUCKETS)
+        self.counters = collections.Counter()
+
+    def observe(self, stage, ms):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(self.LATENCY_BUCKETS_MS)
+            self.stages[stage].observe(ms)
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(stage, (timer() - start) * 1000.0)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe_batch(self, rows):
+        with self.lock:
+            self.batch_sizes.observe(rows)
+
+    def observe_request(self, rows):
+        with self.lock:
+            self.request_sizes.observe(rows)
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'pid' : os.getpid(),
+                'counters' : dict(self.counters),
+                'stages_ms' : {name : h.to_json() for name, h in self.stages.items()},
+                'batch_size' : self.batch_sizes.to_json(),
+                'request_size' : self.request_sizes.to_json(),
+            }
+
+class EncoderCache:
+    # LRU cache of encoder outputs keyed by the token ids of a neighbor window.
+    # Only the windows missing from the cache are run through the encoder
+
+    ENTRY_OVERHEAD = 256  # Approximate bytes used by the key and the bookkeeping of one entry
+
+    def __init__(self, encoder, units, max_bytes):
+        self.encoder = encoder
+        self.units = units
+        self.capacity = max(1, int(max_bytes // (units * 4 + self.ENTRY_OVERHEAD)))
+        self.values = np.zeros([self.capacity, units], dtype=np.float32)
+        self.slots = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def predict(self, ids):
+        uniq, inverse = np.unique(ids, axis=0, return_inverse=True)
+        keys = [row.tobytes() for row in uniq]
+        out = np.empty([len(uniq), self.units], dtype=np.float32)
+        missing = []
+        with self.lock:
+            for n, key in enumerate(keys):
+                slot = self.slots.get(key)
+                if slot is None:
+                    missing.append(n)
+                else:
+                    self.slots.move_to_end(key)
+                    out[n] = self.values[slot]
+            self.hits += len(ids) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            computed = self.encoder.predict(uniq[missing])
+            out[missing] = computed
+            with self.lock:
+                for n, value in zip(missing, computed):
+                    slot = self.slots.get(keys[n])
+                    if slot is not None:
+                        self.slots.move_to_end(keys[n])
+                    elif len(self.slots) < self.capacity:
+                        slot = len(self.slots)
+                    else:
+                        slot = self.slots.popitem(last=False)[1]
+                        self.evictions += 1
+                    self.slots[keys[n]] = slot
+                    self.values[slot] = value
+
+        return out[inverse.reshape([-1])]
+
+    def stats(self):
+        with self.lock:
+            return {'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+                    'entries' : len(self.slots), 'capacity' : self.capacity}
+
+class FullSoftmaxLSTM:
+    # Materializes the whole softmax output of the Keras LSTM and keeps the top k
+
+    def __init__(self, lstm):
+        self.lstm = lstm
+
+    def forward(self, x):
+        return self.lstm.predict(x)
+
+    def topk(self, out, k):
+        return topk(out, k)
+
+    def predict_topk(self, x, k):
+        return self.topk(self.forward(x), k)
+
+class BlockedTopKLSTM:
+    # Runs the Keras LSTM up to its hidden state and computes the output layer
+    # in column blocks, keeping only the top k entries of every row
+
+    def __init__(self, lstm, block):
+        from keras.engine import Model
+        dense = keras_dense_layer(lstm)
+        self.hidden = Model(lstm.input, dense.input)
+        self.kernel, self.bias = dense.get_weights()
+        self.block = block
+
+    def forward(self, x):
+        return self.hidden.predict(x)
+
+    def topk(self, out, k):
+        return softmax_topk(out, self.kernel, self.bias, k, self.block)
+
+    def predict_topk(self, x, k):
+        return self.topk(self.forward(x), k)
+
+class FusedModel:
+    # Runs the single-graph export of training.py -u, from the token ids of the
+    # contexts to the top-k words in one Keras predict call. Its output packs
+    # the top-k probabilities and the (float) ids of every row
+
+    def __init__(self, model):
+        self.model = model
+        self.k = model.output_shape[-1] // 2
+
+    def predict_topk(self, ctx, k):
+        if k > self.k:
+            raise ValueError("The fused model only computes the top {} words".format(self.k))
+        out = self.model.predict(ctx)
+        return out[:,:k], out[:,self.k:self.k+k].astype(np.int64)
+
+def load_keras_models(args, input_vocab_size):
+    # Returns the encoder and LSTM wrappers along with the Keras models they run
+    from keras.models import load_model
+    keras_encoder = load_model(args.encoder)
+    keras_lstm = load_model(args.lstm)
+    if args.one_hot:
+        encoder = OneHotEncoder(keras_encoder, input_vocab_size)
+    else:
+        encoder = GatherEncoder.from_keras(keras_encoder)
+    if args.full_softmax:
+        lstm = FullSoftmaxLSTM(keras_lstm)
+    else:
+        lstm = BlockedTopKLSTM(keras_lstm, args.softmax_block)
+    keras_models = [keras_encoder, keras_lstm] + ([lstm.hidden] if isinstance(lstm, BlockedTopKLSTM) else [])
+    return encoder, lstm, keras_models
+
+def row_bytes(one_hot, full_softmax, softmax_block):
+    # Rough peak number of bytes of intermediate float32 arrays per variable
+    n = config.SEQ_LEN * config.N_NEIGHBORS * 4 * config.HIDDEN_LAYER_SIZE  # Encoder input projections
+    if one_hot:
+        n += config.SEQ_LEN * config.N_NEIGHBORS * config.INPUT_VOCAB_SIZE
+    n += (config.SEQ_LEN + 2) * 4 * config.HIDDEN_LAYER_SIZE2  # LSTM input projections and gates
+    if full_softmax:
+        n += 2 * config.OUTPUT_VOCAB_SIZE
+    else:
+        n += 3 * softmax_block  # Logits, their exponentials and the top-k candidates of a block
+    return 4 * n
+
+def run_models(encoder, lstm, ctx):
+    # Streams the contexts through the models in chunks of at most CHUNK_ROWS
+    # rows, so that the peak memory stays within the budget however large the
+    # request, and keeps only the top-k of every row
+    metrics.observe_batch(len(ctx))
+    chunk = config.CHUNK_ROWS or len(ctx)
+    probs = np.empty([len(ctx), config.TOP_K], dtype=np.float32)
+    ids = np.empty([len(ctx), config.TOP_K], dtype=np.int64)
+    for c in range(0, len(ctx), chunk):
+        probs[c:c+chunk], ids[c:c+chunk] = run_chunk(encoder, lstm, ctx[c:c+chunk])
+    return probs, ids
+
+def run_chunk(encoder, lstm, ctx):
+    # The top-k stage includes the output layer when it is computed in blocks.
+    # A fused model has no separate encoder and runs all stages at once
+    if encoder is None:
+        with metrics.time('fused'):
+            return lstm.predict_topk(ctx, config.TOP_K)
+    with metrics.time('encode'):
+        encoder_out = encoder.predict(ctx.reshape([-1,config.N_NEIGHBORS]))
+    lstm_inp = encoder_out.reshape([len(ctx),config.SEQ_LEN,-1])
+    with metrics.time('lstm'):
+        out = lstm.forward(lstm_inp)
+    with metrics.time('topk'):
+        return lstm.topk(out, config.TOP_K)
+
+def topk(prediction, k):
+    # Returns the k best (probability, index) pairs of every row, best first.
+    # Ties are broken by the smaller index
+    ids = bottleneck.argpartition(-prediction, k, axis=1)[:,:k]
+    probs = np.take_along_axis(prediction, ids, axis=1)
+    order = np.lexsort((ids, -probs), axis=1)
+    return np.take_along_axis(probs, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+class BatchRequest:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class Batcher(threading.Thread):
+    # Merges the requests of concurrent handlers arriving within a short window
+    # into a single encoder/LSTM batch and hands every request its own rows back
+
+    def __init__(self, run, window_ms, max_rows):
+        threading.Thread.__init__(self, daemon=True)
+        self.run_fn = run
+        self.window = window_ms / 1000.0
+        self.max_rows = max_rows
+        self.queue = queue.Queue()
+
+    def submit(self, ctx):
+        req = BatchRequest(ctx)
+        self.queue.put(req)
+        with metrics.time('queue_wait'):
+            req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def collect(self):
+        reqs = [self.queue.get()]
+        rows = len(reqs[0].ctx)
+        deadline = timer() + self.window
+        while rows < self.max_rows:
+            remaining = deadline - timer()
+            if remaining <= 0:
+                break
+            try:
+                req = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            reqs.append(req)
+            rows += len(req.ctx)
+        return reqs
+
+    def run(self):
+        while True:
+            reqs = self.collect()
+            try:
+                probs, ids = self.run_fn(np.concatenate([r.ctx for r in reqs]))
+                offset = 0
+                for r in reqs:
+                    r.result = probs[offset:offset+len(r.ctx)], ids[offset:offset+len(r.ctx)]
+                    offset += len(r.ctx)
+            except Exception as e:
+                for r in reqs:
+                    r.error = e
+            for r in reqs:
+                r.done.set()
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve_forked(n_workers, serve):
+    # Pre-fork serving: the workers inherit the listening socket, the loaded
+    # vocabularies and the memory-mapped weights of the parent, so the weight
+    # pages are shared between all of them and the kernel spreads the incoming
+    # connections among the workers. Workers that die are restarted
+    workers = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve()
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    for _ in range(n_workers):
+        spawn()
+    print("Started {} workers".format(n_workers))
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid in workers:
+                workers.remove(pid)
+                print("Worker {} exited with status {}, restarting".format(pid, status))
+                spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
 class DPLServer(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connections of clients open across requests, so every
+    # response carries a Content-Length. Only threaded servers keep them open:
+    # a server handling one connection at a time would leave the other clients
+    # waiting until KEEPALIVE_TIMEOUT_S. Responses are written as a header and
+    # a body write, without Nagle's algorithm holding back the body
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
 
-    def __init__(self, imap, omap, encoder, lstm, *args):
+    def __init__(self, imap, omap, token_ids, encoder, lstm, batcher, *args):
         self.imap = imap
         self.omap = omap
+        self.token_ids = token_ids
         self.encoder = encoder
         self.lstm = lstm
+        self.batcher = batcher
+        self.timeout = config.KEEPALIVE_TIMEOUT_S
         BaseHTTPRequestHandler.__init__(self, *args)
 
-    def _set_response(self):
+    def _set_response(self, length):
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(length))
+        if not isinstance(self.server, ThreadingMixIn):
+            # Sets close_connection
+            self.send_header('Connection', 'close')
         self.end_headers()
 
     def log_message(self, format, *args):
         return
 
     def parse_input(self, inp):
-        contexts = []
+        # Returns the first SEQ_LEN * N_NEIGHBORS context tokens of all the lines
+        # as one flat list, along with the number of tokens of every line
+        req = config.SEQ_LEN * config.N_NEIGHBORS
+        tokens = []
+        lengths = np.empty(len(inp), dtype=np.int32)
         targets = []
-        for line in inp:
-            tokens = line.split()
-            target = tokens[1]
-            context = tokens[2:]
-            def translator(x):
-                if x.startswith("1ID:-1") : return x.split(':')[2]
-                if x.startswith("1ID:0") : return x.split(':')[2]
-                if x.startswith("1ID") : return "1ID"
-                return x
-
-            context = list(map(translator, context))
-            req = config.SEQ_LEN * config.N_NEIGHBORS
-            if len(context) < req:
-                context += [config.PAD_TOKEN] * req
-
-            context = context[:req]
-            context.reverse()
-            contexts.append(context)
-            targets.append(target)
-
-        return contexts, targets
+        for n, line in enumerate(inp):
+            parts = line.split(None, req + 2)
+            targets.append(parts[1])
+            context = parts[2:2+req]
+            tokens.extend(context)
+            lengths[n] = len(context)
+
+        return tokens, lengths, targets
 
     def prepare_input(self, inp):
-        d = self.imap[1][config.UNKNOWN_TOKEN]
-        ctxs = []
-        for ctx in inp[0]:
-            ctxs.append(list(map(lambda x : self.imap[1].get(x, d), ctx)))
-        return np.array(ctxs), inp[1]
+        # Pads every context to SEQ_LEN * N_NEIGHBORS tokens and reverses it
+        tokens, lengths, targets = inp
+        req = config.SEQ_LEN * config.N_NEIGHBORS
+        ctxs = np.full([len(lengths), req], self.token_ids.pad, dtype=np.int32)
+        ctxs[np.arange(req) < lengths[:,None]] = self.token_ids.lookup(tokens)
+        return np.ascontiguousarray(ctxs[:,::-1]), targets
 
     def prepare_output(self, out):
-        return list(map(lambda y : list(map(lambda x : (-x[0], self.omap[2].get(x[1], config.UNKNOWN_TOKEN), x[2]), y)), out))
+        names = iter(self.omap[2].words([x[1] for y in out for x in y], config.UNKNOWN_TOKEN))
+        return [[(-x[0], next(names), x[2]) for x in y] for y in out]
+
+    def run(self, inp):
+        # Returns the top-k probabilities and ids of all the testcases, and their targets
+        with metrics.time('parse_input'):
+            parsed = self.parse_input(inp)
+        with metrics.time('prepare_input'):
+            ctx, o = self.prepare_input(parsed)
+        metrics.observe_request(len(ctx))
+        if len(ctx) == 0:
+            probs, ids = np.zeros([0,config.TOP_K]), np.zeros([0,config.TOP_K], dtype=np.int64)
+        elif self.batcher is not None:
+            probs, ids = self.batcher.submit(ctx)
+        else:
+            probs, ids = run_models(self.encoder, self.lstm, ctx)
+        return probs, ids, o
+
+    def format_output(self, probs, ids):
+        # The tuples are indexed by the row of probs and ids
+        with metrics.time('prepare_output'):
+            toptens = [[(-float(p), int(j), i) for p, j in zip(probs[i], ids[i])] for i in range(len(ids))]
+            return self.prepare_output(toptens)
 
     def predict(self, inp):
         start = timer()
-        ctx, o = self.prepare_input(self.parse_input(inp))
-        encoder_inp = np_utils.to_categorical(ctx.reshape([-1]), num_classes=self.imap[0]).reshape([-1,config.N_NEIGHBORS,self.imap[0]])
-        encoder_out = self.encoder.predict(encoder_inp)
-        lstm_inp = encoder_out.reshape([-1,config.SEQ_LEN,config.HIDDEN_LAYER_SIZE])
-        prediction = self.lstm.predict(lstm_inp)
-        toptens = bottleneck.argpartition(-prediction, 10, axis=1)[:,:10]
-        toptens = [sorted([(-float(prediction[i][int(j)]), int(j), i) for j in x]) for i, x in enumerate(toptens)]
-        
-        res = self.prepare_output(toptens)
-        end = timer() 
+        probs, ids, o = self.run(inp)
+        res = self.format_output(probs, ids)
+        end = timer()
+        metrics.observe('predict', (end - start) * 1000.0)
         return res, o, (end - start) * 1000.0
 
+    def predict_batch(self, files):
+        # files maps file ids to their testcases. The testcases of all the files
+        # run through the models as one batch, and every file gets the result
+        # predict would have returned for it alone (the runtime is the batch's)
+        start = timer()
+        names = list(files)
+        probs, ids, o = self.run([line for name in names for line in files[name]])
+        parts = []
+        c = 0
+        for name in names:
+            n = len(files[name])
+            parts.append((name, self.format_output(probs[c:c+n], ids[c:c+n]), o[c:c+n]))
+            c += n
+        end = timer()
+        metrics.count('batch_files', len(names))
+        metrics.observe('predict', (end - start) * 1000.0)
+        return {name : (res, targets, (end - start) * 1000.0) for name, res, targets in parts}
+
     def initDPL(self):
         imap, omap, encoder, lstm = get_models()
         self.imap = imap
@@ -119,20 +558,42 @@ class DPLServer(BaseHTTPRequestHandler):
         self.encoder = encoder
         self.lstm = lstm
 
-    def _set_response(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        stats = metrics.to_json()
+        stats['queue_depth'] = self.batcher.queue.qsize() if self.batcher is not None else 0
+        if isinstance(self.encoder, EncoderCache):
+            stats['encoder_cache'] = self.encoder.stats()
+        body = json.dumps(stats).encode("utf-8")
+        self._set_response(len(body))
+        self.wfile.write(body)
 
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode('utf-8'))
-        self._set_response()
-        self.wfile.write(json.dumps(self.predict(data['tests'])).encode("utf-8"))
+        metrics.count('requests')
+        start = timer()
+        try:
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            with metrics.time('json_decode'):
+                data = json.loads(post_data.decode('utf-8'))
+            if self.path == '/batch':
+                res = self.predict_batch(data['files'])
+            else:
+                res = self.predict(data['tests'])
+            with metrics.time('json_encode'):
+                body = json.dumps(res).encode("utf-8")
+        except:
+            metrics.count('errors')
+            raise
+        self._set_response(len(body))
+        self.wfile.write(body)
+        metrics.observe('request', (timer() - start) * 1000.0)
 
 if __name__ == "__main__":
     config = Config()
+    metrics = Metrics()
     parser = argparse.ArgumentParser()
     parser.add_argument('--differentiate-toplevel', action='store_true', default=False,
                         help='Treat vars with scope-id = 0 different from scope-id = -1')
@@ -140,12 +601,12 @@ if __name__ == "__main__":
     i_map_default = "i_" + str(config.INPUT_VOCAB_SIZE) + "_" + config.PROCESSED_FILE
     parser.add_argument('-i', type=str, default=i_map_default,
                         dest='iload',
-                        help='Input vocabulary file')
+                        help='Input vocabulary directory (or pickle of earlier versions)')
 
     o_map_default = "o_" + str(config.OUTPUT_VOCAB_SIZE) + "_" + config.PROCESSED_FILE
     parser.add_argument('-o', type=str, default=o_map_default,
                         dest='oload',
-                        help='Output vocabulary file')
+                        help='Output vocabulary directory (or pickle of earlier versions)')
 
     encoder_default = "encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE
     parser.add_argument('-e', type=str, default=encoder_default,
@@ -157,20 +618,119 @@ if __name__ == "__main__":
                         dest='lstm',
                         help='LSTM Model file')
 
+    frozen_default = config.FROZEN_DIR + "_" + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE)
+    parser.add_argument('-f', type=str, nargs='?', const=frozen_default, default=None,
+                        dest='frozen',
+                        help='Run the frozen NumPy export of the models (created with training.py -x, or a quantized copy from training.py -q) instead of the Keras models. ' +
+                             'Defaults to ' + frozen_default)
+
+    fused_default = "fused_" + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE
+    parser.add_argument('-u', type=str, nargs='?', const=fused_default, default=None,
+                        dest='fused',
+                        help='Run the single-graph Keras export of the models (created with training.py -u) instead of the separate encoder and LSTM. ' +
+                             'Defaults to ' + fused_default)
+
+    parser.add_argument('--one-hot', action='store_true', default=False,
+                        dest='one_hot',
+                        help='Feed the Keras encoder dense one-hot inputs instead of gathering rows of its input weights')
+    parser.add_argument('--encoder-cache', type=float, default=config.ENCODER_CACHE_MB,
+                        dest='encoder_cache',
+                        help='Megabytes of encoder outputs to keep in the LRU cache (0 disables the cache)')
+    parser.add_argument('--full-softmax', action='store_true', default=False,
+                        dest='full_softmax',
+                        help='Materialize the full output softmax of the Keras LSTM instead of computing the top-k in blocks')
+    parser.add_argument('--softmax-block', type=int, default=config.SOFTMAX_BLOCK,
+                        dest='softmax_block',
+                        help='Number of output words per block of the top-k output layer')
+    parser.add_argument('--memory-budget', type=float, default=config.MEMORY_BUDGET_MB,
+                        dest='memory_budget',
+                        help='Megabytes of intermediate arrays a model batch may use. Larger batches are run in chunks')
+
+    parser.add_argument('--concurrent', action='store_true', default=False,
+                        help='Serve requests on concurrent threads and merge them into shared model batches')
+    parser.add_argument('--batch-window', type=float, default=config.BATCH_WINDOW_MS,
+                        dest='batch_window',
+                        help='Milliseconds to wait for other requests to join a batch (with --concurrent)')
+    parser.add_argument('--max-batch', type=int, default=config.MAX_BATCH_ROWS,
+                        dest='max_batch',
+                        help='Maximum number of variables in a merged batch (with --concurrent)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of pre-forked worker processes sharing the memory-mapped weights (requires -f)')
+
     args = parser.parse_args()
+    if args.workers > 1 and not args.frozen:
+        parser.error("--workers requires the memory-mapped frozen models (-f)")
 
-    imap = pickle.load(open(args.iload, 'rb'))
-    omap = pickle.load(open(args.oload, 'rb'))
-    encoder = load_model(args.encoder)
-    lstm = load_model(args.lstm)
+    imap = load_map(args.iload)
+    omap = load_map(args.oload)
+    token_ids = TokenIds(imap, config.TOKEN_MEMO_SIZE)
+    # The fused model feeds the encoder one-hot inputs and computes the full softmax
+    one_hot = (args.one_hot and not args.frozen) or bool(args.fused)
+    full_softmax = (args.full_softmax and not args.frozen) or bool(args.fused)
+    budget = args.memory_budget * 1024 * 1024
+    if args.frozen:
+        frozen = FrozenModel.load(args.frozen, args.softmax_block)
+        encoder, lstm, keras_models = frozen.encoder, frozen.lstm, []
+        # Quantized weights are dequantized while a chunk runs
+        dequantized = lstm.dequantized_bytes()
+        if dequantized + row_bytes(one_hot, full_softmax, args.softmax_block) > budget:
+            parser.error("--memory-budget of {} MB does not cover the {:.1f} MB of dequantized weights of {} and one variable".format(
+                args.memory_budget, dequantized / (1024 * 1024), args.frozen))
+        budget -= dequantized
+    elif args.fused:
+        from keras.models import load_model
+        lstm = FusedModel(load_model(args.fused))
+        encoder, keras_models = None, [lstm.model]
+    else:
+        encoder, lstm, keras_models = load_keras_models(args, imap[0])
+    if args.encoder_cache > 0 and encoder is not None:
+        encoder = EncoderCache(encoder, encoder.units, args.encoder_cache * 1024 * 1024)
 
+    config.CHUNK_ROWS = max(1, int(budget // row_bytes(one_hot, full_softmax, args.softmax_block)))
+    print("Running models in chunks of at most {} variables".format(config.CHUNK_ROWS))
     print("Models loaded!")
 
+    batcher = None
+    run = None
+    if args.concurrent:
+        if keras_models:
+            # The models are only ever run on the batcher thread, so build their
+            # predict functions up-front and run them in the graph they were loaded in
+            from keras import backend as K
+            for model in keras_models:
+                model._make_predict_function()
+            graph = K.get_session().graph
+
+            def run(ctx):
+                with graph.as_default():
+                    return run_models(encoder, lstm, ctx)
+        else:
+            def run(ctx):
+                return run_models(encoder, lstm, ctx)
+
     def handler(*args):
-        return DPLServer(imap, omap, encoder, lstm, *args)
+        return DPLServer(imap, omap, token_ids, encoder, lstm, batcher, *args)
 
-    server = HTTPServer(('0.0.0.0', 8080), handler)
-    try:
-        server.serve_forever()
-    except:
-        pass
+    if args.concurrent:
+        server = ThreadedHTTPServer(('0.0.0.0', 8080), handler)
+    else:
+        server = HTTPServer(('0.0.0.0', 8080), handler)
+
+    def serve():
+        # Threads do not survive a fork, so every worker starts its own batcher
+        global batcher
+        if run is not None:
+            batcher = Batcher(run, args.batch_window, args.max_batch)
+            batcher.start()
+        try:
+            server.serve_forever()
+        except:
+            pass
+
+    if args.workers > 1:
+        # Keep the garbage collector from touching (and so copying) the pages
+        # of the objects loaded before the fork
+        gc.freeze()
+        serve_forked(args.workers, serve)
+    else:
+        serve()
@@ -0,0 +1,281 @@
+import json
+import os
+import numpy as np
+
+# NumPy versions of the forward passes of the Keras layers used by Context2Name.
+# Keras stores the LSTM weights as [kernel, recurrent_kernel, bias] with the
+# gates laid out as (input, forget, cell, output) along the last axis.
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+def linear(x):
+    return x
+
+ACTIVATIONS = {
+    'tanh' : np.tanh,
+    'sigmoid' : sigmoid,
+    'hard_sigmoid' : hard_sigmoid,
+    'linear' : linear,
+}
+
+class QuantizedMatrix:
+    # A (rows, cols) weight matrix stored as int8 with one float32 scale per
+    # column (i.e. per output unit, a row of the transposed Keras kernel), or
+    # as float16 without scales. Column blocks are dequantized on the fly
+
+    def __init__(self, values, scale=None, block=4096):
+        self.values = values
+        self.scale = scale
+        self.block = block
+        self.shape = values.shape
+
+    def __getitem__(self, key):
+        rows, cols = key
+        block = self.values[rows, cols].astype(np.float32)
+        if self.scale is not None:
+            block *= self.scale[cols]
+        return block
+
+    def rdot(self, x):
+        # x.W, dequantizing one block of columns at a time
+        out = np.empty(list(x.shape[:-1]) + [self.shape[1]], dtype=np.float32)
+        for start in range(0, self.shape[1], self.block):
+            cols = slice(start, start + self.block)
+            out[..., cols] = x.dot(self[:, cols])
+        return out
+
+def quantize(arr, mode):
+    # Returns (values, scale) for the given mode, 'int8' or 'float16'
+    arr = np.asarray(arr, dtype=np.float32)
+    if mode == 'float16':
+        return arr.astype(np.float16), None
+    if mode == 'int8':
+        scale = np.abs(arr).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        values = np.clip(np.rint(arr / scale), -127, 127).astype(np.int8)
+        return values, scale.astype(np.float32)
+    raise ValueError("Unknown quantization mode {}".format(mode))
+
+def matmul(x, w):
+    if isinstance(w, QuantizedMatrix):
+        return w.rdot(x)
+    return x.dot(w)
+
+def lstm_forward(x_proj, recurrent_kernel, activation='tanh', recurrent_activation='hard_sigmoid'):
+    # x_proj holds the input projections x.W + b of every timestep, shape (N, T, 4 * units).
+    # Returns the last hidden state, shape (N, units)
+    if isinstance(recurrent_kernel, QuantizedMatrix):
+        # Dequantized once per call rather than at every timestep
+        recurrent_kernel = recurrent_kernel[:, :]
+    act = ACTIVATIONS[activation]
+    rec_act = ACTIVATIONS[recurrent_activation]
+    units = recurrent_kernel.shape[0]
+    h = np.zeros([x_proj.shape[0], units], dtype=np.float32)
+    c = np.zeros([x_proj.shape[0], units], dtype=np.float32)
+    for t in range(x_proj.shape[1]):
+        z = x_proj[:, t, :] + matmul(h, recurrent_kernel)
+        i = rec_act(z[:, :units])
+        f = rec_act(z[:, units:2*units])
+        c = f * c + i * act(z[:, 2*units:3*units])
+        o = rec_act(z[:, 3*units:])
+        h = o * act(c)
+    return h
+
+def keras_lstm_layer(model):
+    from keras.layers.recurrent import LSTM
+    return [layer for layer in model.layers if isinstance(layer, LSTM)][0]
+
+def keras_dense_layer(model):
+    from keras.layers.core import Dense
+    return [layer for layer in model.layers if isinstance(layer, Dense)][-1]
+
+def lstm_weights(layer):
+    weights = layer.get_weights()
+    bias = weights[2] if len(weights) > 2 else np.zeros(weights[1].shape[1], dtype=np.float32)
+    cfg = layer.get_config()
+    return weights[0], weights[1], bias, cfg['activation'], cfg['recurrent_activation']
+
+class GatherEncoder:
+    # Runs the encoder LSTM on integer token ids. Multiplying a one-hot vector
+    # with the input kernel just selects one of its rows, so the input
+    # projection is a row gather instead of a (vocab x 4 * units) matmul
+
+    def __init__(self, kernel, recurrent_kernel, bias, activation, recurrent_activation):
+        self.kernel = kernel
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.activation = activation
+        self.recurrent_activation = recurrent_activation
+        self.units = recurrent_kernel.shape[0]
+
+    @staticmethod
+    def from_keras(encoder):
+        return GatherEncoder(*lstm_weights(keras_lstm_layer(encoder)))
+
+    def predict(self, ids):
+        # ids : (N, N_NEIGHBORS) token ids
+        x_proj = self.kernel[ids] + self.bias
+        return lstm_forward(x_proj, self.recurrent_kernel, self.activation, self.recurrent_activation)
+
+def softmax_topk(hidden, kernel, bias, k, block=4096):
+    # Top-k entries of softmax(hidden.kernel + bias) computed over column blocks
+    # of the kernel. Only (N, block) logits are alive at any time; the running
+    # top-k logits and a running log-sum-exp are kept for every row, so the
+    # probabilities of the k entries are exact without materializing all of them.
+    # Returns (probs, ids) of shape (N, k), best first, ties broken by the smaller id
+    n = hidden.shape[0]
+    best_logits = np.full([n, k], -np.inf, dtype=np.float32)
+    best_ids = np.zeros([n, k], dtype=np.int64)
+    m = np.full([n, 1], -np.inf, dtype=np.float32)
+    s = np.zeros([n, 1], dtype=np.float32)
+    for start in range(0, kernel.shape[1], block):
+        logits = hidden.dot(kernel[:, start:start+block]) + bias[start:start+block]
+        new_m = np.maximum(m, logits.max(axis=1, keepdims=True))
+        s = s * np.exp(m - new_m) + np.exp(logits - new_m).sum(axis=1, keepdims=True)
+        m = new_m
+
+        ids = np.arange(start, start + logits.shape[1])
+        cand_logits = np.concatenate([best_logits, logits], axis=1)
+        cand_ids = np.concatenate([best_ids, np.broadcast_to(ids, logits.shape)], axis=1)
+        part = np.argpartition(-cand_logits, k - 1, axis=1)[:, :k]
+        best_logits = np.take_along_axis(cand_logits, part, axis=1)
+        best_ids = np.take_along_axis(cand_ids, part, axis=1)
+
+    probs = np.exp(best_logits - m) / s
+    order = np.lexsort((best_ids, -probs), axis=1)
+    return np.take_along_axis(probs, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+class FrozenLSTM:
+    # NumPy forward pass of the variable name LSTM followed by the top-k
+    # of its softmax output layer
+
+    def __init__(self, kernel, recurrent_kernel, bias, activation, recurrent_activation,
+                 dense_kernel, dense_bias, block=4096):
+        self.kernel = kernel
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.activation = activation
+        self.recurrent_activation = recurrent_activation
+        self.dense_kernel = dense_kernel
+        self.dense_bias = dense_bias
+        self.block = block
+
+    def forward(self, x):
+        # x : (N, SEQ_LEN, HIDDEN_LAYER_SIZE) encoder outputs. Returns the hidden state
+        x_proj = matmul(x, self.kernel) + self.bias
+        return lstm_forward(x_proj, self.recurrent_kernel, self.activation, self.recurrent_activation)
+
+    def topk(self, hidden, k):
+        return softmax_topk(hidden, self.dense_kernel, self.dense_bias, k, self.block)
+
+    def predict_topk(self, x, k):
+        return self.topk(self.forward(x), k)
+
+    def dequantized_bytes(self):
+        # Peak bytes of dequantized weights alive while a batch runs, whatever
+        # its size: the whole recurrent kernel, or a column block of the others
+        sizes = [0]
+        if isinstance(self.recurrent_kernel, QuantizedMatrix):
+            sizes.append(4 * self.recurrent_kernel.shape[0] * self.recurrent_kernel.shape[1])
+        if isinstance(self.kernel, QuantizedMatrix):
+            sizes.append(4 * self.kernel.shape[0] * min(self.kernel.block, self.kernel.shape[1]))
+        if isinstance(self.dense_kernel, QuantizedMatrix):
+            sizes.append(4 * self.dense_kernel.shape[0] * min(self.block, self.dense_kernel.shape[1]))
+        return max(sizes)
+
+# Frozen models are stored as a directory with one .npy file per weight array
+# and a meta.json with the activations, so that they can be memory-mapped.
+# Quantized exports store the arrays in QUANTIZED_ARRAYS as int8 (with a
+# <name>_scale.npy next to them) or float16
+
+FROZEN_ARRAYS = ['encoder_kernel', 'encoder_recurrent_kernel', 'encoder_bias',
+                 'lstm_kernel', 'lstm_recurrent_kernel', 'lstm_bias',
+                 'dense_kernel', 'dense_bias']
+QUANTIZED_ARRAYS = ['lstm_kernel', 'lstm_recurrent_kernel', 'dense_kernel']
+
+def freeze(path, encoder, lstm):
+    # Writes the weights of the trained Keras encoder and LSTM models to path
+    e_kernel, e_recurrent, e_bias, e_act, e_rec_act = lstm_weights(keras_lstm_layer(encoder))
+    l_kernel, l_recurrent, l_bias, l_act, l_rec_act = lstm_weights(keras_lstm_layer(lstm))
+    d_kernel, d_bias = keras_dense_layer(lstm).get_weights()
+    arrays = [e_kernel, e_recurrent, e_bias, l_kernel, l_recurrent, l_bias, d_kernel, d_bias]
+
+    os.makedirs(path, exist_ok=True)
+    for name, arr in zip(FROZEN_ARRAYS, arrays):
+        np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(arr, dtype=np.float32))
+    meta = {
+        'quantization' : None,
+        'encoder_activation' : e_act,
+        'encoder_recurrent_activation' : e_rec_act,
+        'lstm_activation' : l_act,
+        'lstm_recurrent_activation' : l_rec_act,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+class FrozenModel:
+
+    def __init__(self, encoder, lstm):
+        self.encoder = encoder
+        self.lstm = lstm
+
+    @staticmethod
+    def load(path, block=4096, mmap=True):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        w = {name : np.load(os.path.join(path, name + ".npy"), mmap_mode=mode) for name in FROZEN_ARRAYS}
+        if meta.get('quantization'):
+            for name in QUANTIZED_ARRAYS:
+                scale_file = os.path.join(path, name + "_scale.npy")
+                scale = np.load(scale_file) if os.path.exists(scale_file) else None
+                w[name] = QuantizedMatrix(w[name], scale, block)
+        encoder = GatherEncoder(w['encoder_kernel'], w['encoder_recurrent_kernel'], w['encoder_bias'],
+                                meta['encoder_activation'], meta['encoder_recurrent_activation'])
+        lstm = FrozenLSTM(w['lstm_kernel'], w['lstm_recurrent_kernel'], w['lstm_bias'],
+                          meta['lstm_activation'], meta['lstm_recurrent_activation'],
+                          w['dense_kernel'], w['dense_bias'], block)
+        return FrozenModel(encoder, lstm)
+
+def quantize_frozen(src, dst, mode):
+    # Writes a copy of the frozen export in src to dst with the large LSTM
+    # and output layer weights quantized
+    with open(os.path.join(src, "meta.json"), "r") as f:
+        meta = json.load(f)
+    os.makedirs(dst, exist_ok=True)
+    for name in FROZEN_ARRAYS:
+        arr = np.load(os.path.join(src, name + ".npy"), mmap_mode='r')
+        if name in QUANTIZED_ARRAYS:
+            arr, scale = quantize(arr, mode)
+            if scale is not None:
+                np.save(os.path.join(dst, name + "_scale.npy"), scale)
+        np.save(os.path.join(dst, name + ".npy"), arr)
+    meta['quantization'] = mode
+    with open(os.path.join(dst, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+def check_frozen(frozen, encoder, lstm, input_vocab_size, n_neighbors, seq_len, n_samples=256, k=10, seed=0):
+    # Compares the frozen NumPy engine against the Keras models on random
+    # contexts. Returns the largest absolute differences of the encoder outputs
+    # and of the top-k probabilities, and the fraction of rows whose top-k
+    # words differ
+    from keras.utils import np_utils
+    rng = np.random.RandomState(seed)
+    ids = rng.randint(0, input_vocab_size, size=[n_samples * seq_len, n_neighbors])
+    one_hot = np_utils.to_categorical(ids.reshape([-1]), num_classes=input_vocab_size).reshape([-1, n_neighbors, input_vocab_size])
+    keras_encoded = encoder.predict(one_hot)
+    frozen_encoded = frozen.encoder.predict(ids)
+    encoder_diff = float(np.abs(keras_encoded - frozen_encoded).max())
+
+    lstm_inp = keras_encoded.reshape([n_samples, seq_len, -1])
+    prediction = lstm.predict(lstm_inp)
+    keras_ids = np.argsort(-prediction, axis=1, kind='stable')[:, :k]
+    keras_probs = np.take_along_axis(prediction, keras_ids, axis=1)
+    frozen_probs, frozen_ids = frozen.lstm.predict_topk(lstm_inp, k)
+    prob_diff = float(np.abs(keras_probs - frozen_probs).max())
+    mismatch = float(np.mean(np.any(np.sort(keras_ids, axis=1) != np.sort(frozen_ids, axis=1), axis=1)))
+    return encoder_diff, prob_diff, mismatch
@@ -1,22 +1,35 @@
 import numpy as np
 import collections
+import glob
+import hashlib
 import pickle
+import queue
+import shutil
+import threading
 # import os.path
 # import operator
 import argparse
+import itertools
 import json
+import os
+import subprocess
+import sys
+import time
 
-
+import np_engine
+import vocab
 
 from keras import Input
-from keras.engine import Model
+from keras import backend as K
+from keras.engine import Layer, Model
 from keras.preprocessing import sequence
 from keras.utils import np_utils
-from keras.layers.core import Activation, Dense, RepeatVector
+from keras.layers.core import Activation, Dense, Lambda, RepeatVector, Reshape
 from keras.layers.recurrent import LSTM
 from keras.models import Sequential
 from keras.models import load_model
 from keras.layers.wrappers import TimeDistributed
+from timeit import default_timer as timer
 
 
 class Config:
@@ -39,11 +52,36 @@ class Config:
         self.CHUNK_SIZE1 = 25000
         self.CHUNK_SIZE2 = 20000
 
-        self.PROCESSED_FILE="vocab.pkl"
+        self.PROCESSED_FILE="vocab"  # directory of the memory-mapped vocabulary
+        self.PROCESSED_ARRAYS = "arrays"
         self.TRAINING_FILE = "training.csv"  # space separated
         self.EVAL_FILE = "eval.csv"  # space separated
         self.MODEL_FILE = "model.h5"
         self.CONFIG_FILE = "config.json"
+        self.FROZEN_DIR = "frozen"
+        self.FROZEN_TOLERANCE = 1e-4
+        self.FUSED_FILE = "fused"
+        self.FUSED_TOP_K = 10
+        self.EVAL_BATCH_SIZE = 1024
+        self.ENCODED_FILE = "encoded"
+        self.ENCODED_DTYPE = "float16"
+        self.PREFETCH_DEPTH = 2  # Chunks prepared ahead of training, their LSTM targets are kept as ids
+        self.SEED = 1234
+        self.NUM_SAMPLED = 0  # Number of sampled classes of the sampled softmax, 0 trains the full softmax
+        self.CHECKPOINT_DIR = "checkpoint"
+        self.CHECKPOINT_EVERY = 10  # chunks
+        self.BENCHMARK_DIR = "benchmark"
+        self.BENCHMARK_FILE = "benchmark.json"
+        self.SHARD_PATTERN = "*.csv"
+        self.VOCAB_COUNTER_SIZE = 5000000  # distinct tokens counted at a time when counting shards
+        self.SHUFFLE_BUFFER = 100000  # records
+        self.SHARDS_FILE = "shards.json"  # Number of training records of the shards
+        self.STUDENT_HIDDEN_LAYER_SIZE = 40
+        self.STUDENT_HIDDEN_LAYER_SIZE2 = 512
+        self.DISTILL_TOP_K = 10
+        self.DISTILL_ALPHA = 0.1  # Weight of the true output in the student loss, the teacher's top-k get the rest
+        self.DISTILL_EVAL_SIZE = 20000
+        self.LATENCY_RUNS = 100
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -59,63 +97,142 @@ def parse_args():
                         help='Load output vocabulary')
     parser.add_argument('-a', action='store_true', default=False,
                         dest='load_model1',
-                        help='Load encoder model from file')
+                        help='Load encoder model from file, or resume its training from the last checkpoint')
     parser.add_argument('-b', action='store_true', default=False,
                         dest='load_model2',
-                        help='Load LSTM model from file')
+                        help='Load LSTM model from file, or resume its training from the last checkpoint')
+    parser.add_argument('--sampled-softmax', type=int, default=config.NUM_SAMPLED,
+                        dest='num_sampled',
+                        help='Train the LSTM output layer with a sampled softmax over this many sampled words per batch (0 = full softmax)')
+    parser.add_argument('--seed', type=int, default=config.SEED,
+                        help='Seed of the shuffling of the training and validation data')
+    parser.add_argument('-x', action='store_true', default=False,
+                        dest='export',
+                        help='Export the trained encoder and LSTM models as frozen NumPy weights and exit')
+    parser.add_argument('-u', action='store_true', default=False,
+                        dest='fuse',
+                        help='Export the trained encoder and LSTM models as a single Keras model from token ids to the top-k outputs and exit')
+    parser.add_argument('-q', type=str, choices=['int8', 'float16'], default=None,
+                        dest='quantize',
+                        help='Quantize the frozen export, report the accuracy change on the evaluation set and exit')
+    parser.add_argument('--distill', action='store_true', default=False,
+                        help='Train a small student encoder and LSTM on the top-k outputs of the trained models, compare them and exit')
+    parser.add_argument('--shards', type=str, default=None, metavar='DIR',
+                        help='Stream the training records from the CSV shards in DIR instead of loading training.csv into memory')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='CHUNKS',
+                        help='Time every training stage over this many chunks of a synthetic corpus, write the results to benchmark.json and exit')
+    parser.add_argument('--benchmark-corpus', type=str, default=None, metavar='FILE',
+                        help='Benchmark on the first records of FILE instead of a synthetic corpus')
 
     return parser.parse_args()
 
-def apply_fun(arr, fun):
-    if not isinstance(arr, list):
-        fun(arr)
-    else:
-        for x in arr:
-            apply_fun(x, fun)
-
-def map_fun(arr, fun):
-    for i in range(len(arr)):
-        if not isinstance(arr[i], list):
-            arr[i] = fun(arr[i])
-        else:
-            map_fun(arr[i], fun)
+PREFIX2 = "1ID:-1:"
+PREFIX3 = "1ID:0:"
 
+def strip_prefix(token):
+    if token.startswith(PREFIX2):
+        return token[len(PREFIX2):]
+    elif token.startswith(PREFIX3):
+        return token[len(PREFIX3):]
+    elif token.startswith("1ID:"):
+        return "1ID"
+    return token
 
-def load_inputs(input_file, map=None):
-    input_arr = []
-    output_arr = []
-    prefix2 = "1ID:-1:"
-    prefix3 = "1ID:0:"
-    header_len = 2
-    lines = []
+def read_records(input_file):
+    # Streams the (output name, context tokens) of the non-global variables in
+    # input_file. Only the first SEQ_LEN * N_NEIGHBORS context tokens are kept
+    req = config.SEQ_LEN * config.N_NEIGHBORS
     with open(input_file, "r") as file:
         for line in file:
-            line = line.rstrip()
-            lines.append(line)
+            tokens = line.split(None, req + 2)
+            if not tokens[1].startswith(PREFIX2):
+                yield tokens[1].split(":")[2], tokens[2:2+req]
+
+def count_lines(input_file):
+    with open(input_file, "rb") as file:
+        return sum(block.count(b"\n") for block in iter(lambda: file.read(1 << 20), b"")) + 1
+
+class TokenIndexer:
+    # Maps raw context tokens to input vocabulary ids, memoizing the id of
+    # every distinct raw token
+
+    def __init__(self, i_map, max_size=1000000):
+        self.word2index = i_map[1]
+        self.unk = i_map[1][config.UNKNOWN_TOKEN]
+        self.max_size = max_size
+        self.memo = {}
+
+    def get(self, token):
+        i = self.memo.get(token)
+        if i is None:
+            if len(self.memo) > self.max_size:
+                self.memo.clear()
+            i = self.memo[token] = self.word2index.get(strip_prefix(token), self.unk)
+        return i
+
+    def lookup(self, tokens):
+        return np.fromiter(map(self.get, tokens), dtype=np.int32, count=len(tokens))
+
+def prune(freqs, size):
+    # Keeps the size most frequent tokens. A dropped token that comes back is
+    # undercounted, which only matters for tokens near the vocabulary cut-off
+    kept = freqs.most_common(size)
+    freqs.clear()
+    freqs.update(dict(kept))
+
+def count_tokens(input_files, max_size=None):
+    # Streaming frequency pass over the input and output tokens of one file or
+    # a list of files. Contexts are counted padded and reversed, as they are fed
+    # to the model. With max_size, each Counter is pruned to its max_size / 2
+    # most frequent tokens whenever it grows past max_size
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    req = config.SEQ_LEN * config.N_NEIGHBORS
+    i_freqs = collections.Counter()
+    o_freqs = collections.Counter()
+    n = 0
+    for input_file in input_files:
+        for output, context in read_records(input_file):
+            o_freqs[output] += 1
+            x = list(map(strip_prefix, context))
+            x += [config.PAD_TOKEN] * (req - len(x))
+            x.reverse()
+            i_freqs.update(x)
+            n += 1
+            if max_size is not None and n % 1000 == 0:
+                for freqs in (i_freqs, o_freqs):
+                    if len(freqs) > max_size:
+                        prune(freqs, max_size // 2)
+        print("Counted tokens of {} records up to {}".format(n, input_file))
+    return i_freqs, o_freqs
+
+def fill_context(row, context, indexer, pad):
+    # Writes the ids of context into row, padded at the front and reversed
+    row[:len(row)-len(context)] = pad
+    row[len(row)-len(context):] = indexer.lookup(context)[::-1]
+
+def load_inputs(input_file, i_map, o_map, filter_outputs=False):
+    # Reads input_file straight into int32 arrays of padded and reversed context
+    # ids and output ids. With filter_outputs, only the records whose output is
+    # in the output vocabulary are kept
+    req = config.SEQ_LEN * config.N_NEIGHBORS
+    n_lines = count_lines(input_file)
+    input_arr = np.empty([n_lines, req], dtype=np.int32)
+    output_arr = np.empty([n_lines], dtype=np.int32)
+    indexer = TokenIndexer(i_map)
+    pad = i_map[1][config.PAD_TOKEN]
+    o_word2index = o_map[1]
+    o_unk = o_word2index[config.UNKNOWN_TOKEN]
     j = 0
-    for line in lines:
-        tokens = line.split()
-        if not tokens[1].startswith(prefix2):
-            output = tokens[1].split(":")[2]
-            if map is None or output in map[1]:
-                output_arr.append(output)
-                j += 1
-                x = []
-                input_arr.append(x)
-                length = min(len(tokens) - header_len, config.SEQ_LEN*config.N_NEIGHBORS)
-                for i in range(length):
-                    token = tokens[i + header_len]
-                    if token.startswith(prefix2):
-                        token = token[len(prefix2):]
-                    elif token.startswith(prefix3):
-                        token = token[len(prefix3):]
-                    elif token.startswith("1ID:"):
-                        token = "1ID"
-                    x.append(token)
-                for i in range(length, config.SEQ_LEN*config.N_NEIGHBORS):
-                    x.append(config.PAD_TOKEN)
-                x.reverse()
-    print("Read {} records from {}".format(len(input_arr), input_file))
+    for output, context in read_records(input_file):
+        if filter_outputs and output not in o_word2index:
+            continue
+        output_arr[j] = o_word2index.get(output, o_unk)
+        fill_context(input_arr[j], context, indexer, pad)
+        j += 1
+    input_arr.resize([j, req], refcheck=False)
+    output_arr.resize([j], refcheck=False)
+    print("Read {} records from {} into arrays with shapes {} {}".format(j, input_file, input_arr.shape, output_arr.shape))
     return (input_arr, output_arr)
 
 
@@ -136,80 +253,391 @@ def get_word2index(vocab_size, token_freqs, kth=1):
     print("Done with word to index".format(vocab_size))
     return (vocab_size, word2index, index2word)
 
-def get_index_map(arr, vocab_size=None, kth = 1):
-    token_freqs = collections.Counter()
-    def count(x):
-        token_freqs[x] += 1
-    apply_fun(arr, count)
-    return get_word2index(vocab_size, token_freqs, kth)
 
+# Processed arrays are stored as a directory of fixed-dtype .npy files and a
+# manifest.json describing them. The manifest is written last, so a directory
+# without one is an incomplete write
 
-def indexify_array(arr, map):
-    def f(x):
-        if x in map[1]:
-            return map[1][x]
-        else:
-            return map[1][config.UNKNOWN_TOKEN]
-    map_fun(arr, f)
-    ret = np.array(arr)
-    print("Indexified array with shape {}".format(ret.shape))
-    return ret
+PROCESSED_NAMES = ['training_input', 'training_output', 'validation_input', 'validation_output']
+
+def save_processed(path, training_arr, validation_arr):
+    os.makedirs(path, exist_ok=True)
+    manifest_file = os.path.join(path, "manifest.json")
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    manifest = {}
+    for name, arr in zip(PROCESSED_NAMES, training_arr + validation_arr):
+        np.save(os.path.join(path, name + ".npy"), arr)
+        manifest[name] = {'file' : name + ".npy", 'dtype' : str(arr.dtype), 'shape' : list(arr.shape)}
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    print("Saved processed arrays to {}".format(path))
 
+def load_processed(path):
+    # Memory-maps the processed arrays, only the pages that are used get read
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    arrays = []
+    for name in PROCESSED_NAMES:
+        entry = manifest[name]
+        arr = np.load(os.path.join(path, entry['file']), mmap_mode='r')
+        if str(arr.dtype) != entry['dtype'] or list(arr.shape) != entry['shape']:
+            raise ValueError("{} does not match the manifest of {}".format(entry['file'], path))
+        arrays.append(arr)
+    print("Memory-mapped processed arrays from {}".format(path))
+    return (arrays[0], arrays[1]), (arrays[2], arrays[3])
+
+def load_or_create_vocabs(input_files, max_size=None):
+    # Returns the vocabularies and, when the tokens were counted, the number of
+    # records whose output is in the output vocabulary (None otherwise). The
+    # count is exact unless the output Counter had to be pruned
+    n_records = None
+    if not results.is_iload or not results.is_oload:
+        i_freqs, o_freqs = count_tokens(input_files, max_size)
+    if results.is_iload:
+        i_map = vocab.load_map("i_"+str(config.INPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE)
+    else:
+        i_map = get_word2index(config.INPUT_VOCAB_SIZE, i_freqs)
+        vocab.save_map("i_"+str(config.INPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, i_map)
+    if results.is_oload:
+        o_map = vocab.load_map("o_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE)
+    else:
+        o_map = get_word2index(config.OUTPUT_VOCAB_SIZE, o_freqs, config.KTH_COMMON)
+        vocab.save_map("o_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, o_map)
+    if not results.is_iload or not results.is_oload:
+        n_records = sum(o_freqs.get(o_map[2].get(i), 0) for i in range(o_map[0]))
+    return i_map, o_map, n_records
 
 def load_and_process_arrays():
+    processed_path = "p_"+str(config.INPUT_VOCAB_SIZE)+"_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_ARRAYS
     if results.is_pload:
         results.is_iload = True
         results.is_oload = True
-        (training_arr, validation_arr) = pickle.load(open("p_"+str(config.INPUT_VOCAB_SIZE)+"_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, "rb"))
-    else:
-        training_arr = load_inputs(config.TRAINING_FILE)
-        validation_arr = load_inputs(config.EVAL_FILE)
-    if not results.is_iload and not results.is_oload:
-        i_map = get_index_map(training_arr[0], config.INPUT_VOCAB_SIZE)
-        o_map = get_index_map(training_arr[1], config.OUTPUT_VOCAB_SIZE, config.KTH_COMMON)
-    elif not results.is_oload and results.is_iload:
-        i_map = pickle.load(open("i_"+str(config.INPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, 'rb'))
-        o_map = get_index_map(training_arr[1], config.OUTPUT_VOCAB_SIZE, config.KTH_COMMON)
-    elif not results.is_iload and results.is_oload:
-        o_map = pickle.load(open("o_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, 'rb'))
-        i_map = get_index_map(training_arr[0], config.INPUT_VOCAB_SIZE)
-    else:
-        i_map = pickle.load(open("i_"+str(config.INPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, 'rb'))
-        o_map = pickle.load(open("o_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, 'rb'))
-    if not results.is_iload:
-        pickle.dump(i_map, open("i_"+str(config.INPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, 'wb'))
-    if not results.is_oload:
-        pickle.dump(o_map, open("o_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, 'wb'))
+        (training_arr, validation_arr) = load_processed(processed_path)
+    # The token counters are garbage collected when load_or_create_vocabs returns
+    i_map, o_map, _ = load_or_create_vocabs(config.TRAINING_FILE)
     if not results.is_pload:
-        training_arr = None  # make sure that GC garbage collects the array
-        training_arr = load_inputs(config.TRAINING_FILE, o_map)
-        training_arr = (indexify_array(training_arr[0], i_map), indexify_array(training_arr[1], o_map))
-        validation_arr = (indexify_array(validation_arr[0], i_map), indexify_array(validation_arr[1], o_map))
-        pickle.dump((training_arr, validation_arr), open("p_"+str(config.INPUT_VOCAB_SIZE)+"_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE, "wb"))
+        training_arr = load_inputs(config.TRAINING_FILE, i_map, o_map, filter_outputs=True)
+        validation_arr = load_inputs(config.EVAL_FILE, i_map, o_map)
+        save_processed(processed_path, training_arr, validation_arr)
     return (training_arr, validation_arr, i_map, o_map)
 
+class ShardedCorpus:
+    # Training records streamed from CSV shards, for corpora that do not fit in
+    # memory. Every pass reads the shards in an order drawn from (seed, pass),
+    # and the records are shuffled in windows of SHUFFLE_BUFFER records, so the
+    # memory used is bounded by a window and a chunk. Only the records whose
+    # output is in the output vocabulary are used, as with training.csv.
+    #
+    # A position in the stream is ((pass, shard, record), k): the window that
+    # starts at the given record of the given shard of the pass, of which k
+    # records were used. Checkpoints store the position after their last chunk
+    # (see position), so that resuming reads from that shard on
+
+    def __init__(self, files, i_map, o_map, seed, n_records):
+        self.files = files
+        self.i_map = i_map
+        self.o_map = o_map
+        self.seed = seed
+        self.n_records = n_records
+        self.positions = {}
+        print("Streaming {} records from {} shards".format(self.n_records, len(files)))
+
+    def n_chunks(self, chunk_records):
+        return (self.n_records + chunk_records - 1) // chunk_records
+
+    def records(self, start):
+        # (context ids, output id) records from start = (pass, shard, record),
+        # each with the (pass, shard, record) that follows it. Records of the
+        # start shard before record are skipped without being indexed
+        req = config.SEQ_LEN * config.N_NEIGHBORS
+        indexer = TokenIndexer(self.i_map)
+        pad = self.i_map[1][config.PAD_TOKEN]
+        o_word2index = self.o_map[1]
+        n, first_shard, first_record = start
+        for n in itertools.count(n):
+            order = np.random.RandomState([self.seed, n]).permutation(len(self.files))
+            for s in range(first_shard, len(self.files)):
+                records = itertools.islice(read_records(self.files[order[s]]), first_record, None)
+                for r, (output, context) in enumerate(records, first_record + 1):
+                    if output in o_word2index:
+                        row = np.empty([req], dtype=np.int32)
+                        fill_context(row, context, indexer, pad)
+                        yield (row, o_word2index[output]), (n, s, r)
+                first_record = 0
+            first_shard = 0
+
+    def shuffled(self, position):
+        # Records from position on, each with the position that follows it
+        start, k = position
+        records = self.records(start)
+        while True:
+            window = list(itertools.islice(records, config.SHUFFLE_BUFFER))
+            order = np.random.RandomState([self.seed] + list(start)).permutation(len(window))
+            for j in range(k, len(window)):
+                yield window[order[j]][0], (start, j + 1)
+            start, k = window[-1][1], 0
+
+    def chunks(self, chunk_records, start=0, position=None):
+        # Endless chunks of (context ids, output ids) of chunk_records records,
+        # after start chunks. position is the position after chunk start,
+        # without it the stream is read from the beginning and the first start
+        # chunks are skipped
+        self.positions = {}
+        if position is None:
+            records = itertools.islice(self.shuffled(((0, 0, 0), 0)), start * chunk_records, None)
+        else:
+            records = self.shuffled(position)
+        for c in itertools.count(start + 1):
+            chunk = list(itertools.islice(records, chunk_records))
+            self.positions[c] = chunk[-1][1]
+            print("Streamed chunk of {} records".format(len(chunk)))
+            yield np.stack([r[0][0] for r in chunk]), np.array([r[0][1] for r in chunk], dtype=np.int32)
+
+    def position(self, chunks):
+        # Position after the first chunks chunks. The chunks are generated ahead
+        # of training, so it is recorded when a chunk is generated
+        return self.positions.get(chunks)
+
+def stream_position(corpus, chunks):
+    # For the training state of checkpoints
+    return corpus.position(chunks) if isinstance(corpus, ShardedCorpus) else None
+
+def count_records(files, o_map, n_records):
+    # Number of training records of the shards, kept in SHARDS_FILE along with
+    # the shards and the output vocabulary size it was counted for, so that runs
+    # with loaded vocabularies do not read the shards once more to count them
+    key = {'shards' : [[f, os.path.getsize(f)] for f in files], 'output_vocab_size' : o_map[0]}
+    if n_records is None and os.path.exists(config.SHARDS_FILE):
+        with open(config.SHARDS_FILE, "r") as f:
+            counted = json.load(f)
+        if counted['shards'] == key['shards'] and counted['output_vocab_size'] == key['output_vocab_size']:
+            return counted['n_records']
+    if n_records is None:
+        n_records = sum(1 for f in files for output, context in read_records(f) if output in o_map[1])
+    with open(config.SHARDS_FILE, "w") as f:
+        json.dump(dict(key, n_records=n_records), f)
+    return n_records
+
+def load_sharded_corpus(path):
+    files = sorted(glob.glob(os.path.join(path, config.SHARD_PATTERN)))
+    if not files:
+        raise ValueError("No shards matching {} in {}".format(config.SHARD_PATTERN, path))
+    i_map, o_map, n_records = load_or_create_vocabs(files, config.VOCAB_COUNTER_SIZE)
+    n_records = count_records(files, o_map, n_records)
+    validation_arr = load_inputs(config.EVAL_FILE, i_map, o_map)
+    return (ShardedCorpus(files, i_map, o_map, results.seed, n_records), validation_arr, i_map, o_map)
+
+class Prefetcher:
+    # Runs a chunk generator on a background thread, keeping up to depth chunks
+    # ready in a bounded queue while the model trains on the current one.
+    # stall_time is the time the training loop spent waiting for data. An
+    # exhausted generator ends the iteration through an END entry. Loops
+    # that stop before the generator is exhausted must call close, which stops
+    # the thread and drops the prefetched chunks
+
+    END = object()
+
+    def __init__(self, generator, depth):
+        self.generator = generator
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.stall_time = 0.0
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def produce(self):
+        try:
+            for item in self.generator:
+                if not self.put((item, None)):
+                    return
+            self.put((Prefetcher.END, None))
+        except Exception as e:
+            self.put((None, e))
+
+    def put(self, entry):
+        # Returns False when the prefetcher was closed while waiting for room
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(self):
+        self.stopped.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join()
+        # The suspended generators hold on to the last chunk they yielded
+        self.generator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = timer()
+        item, error = self.queue.get()
+        stall = timer() - start
+        self.stall_time += stall
+        if error is not None:
+            raise error
+        if item is Prefetcher.END:
+            # Later calls raise StopIteration too
+            self.queue.put((item, None))
+            raise StopIteration
+        print("Waited {:.3f}s for data ({:.3f}s in total)".format(stall, self.stall_time))
+        return item
+
+class ChunkSampler:
+    # Yields the row indices of consecutive chunks of a permutation of
+    # range(length) that is drawn from (seed, epoch) at the start of every
+    # epoch. The data is never copied as a whole, every chunk is gathered from
+    # its indices (sorted, for locality on memory-mapped arrays). The last
+    # chunk of an epoch holds the remaining rows and may be smaller
+
+    def __init__(self, length, chunk_size, seed, epoch=0, position=0):
+        self.length = length
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = epoch
+        self.position = position
+        self.perm = None
+
+    def n_chunks(self):
+        return (self.length + self.chunk_size - 1) // self.chunk_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= self.length:
+            self.epoch += 1
+            self.position = 0
+        if self.perm is None or self.perm_epoch != self.epoch:
+            self.perm = np.random.RandomState([self.seed, self.epoch]).permutation(self.length)
+            self.perm_epoch = self.epoch
+        indices = np.sort(self.perm[self.position:self.position+self.chunk_size])
+        self.position += len(indices)
+        return indices
+
+    def seek(self, chunks):
+        # Positions the sampler after the first chunks chunks it yields, every
+        # epoch has n_chunks() of them
+        self.epoch = chunks // self.n_chunks()
+        self.position = (chunks % self.n_chunks()) * self.chunk_size
+
+class Checkpointer:
+    # Saves the weights and optimizer state of a set of models, plus the
+    # training state (the data cursor and the NumPy random state), to the
+    # directory path. The weights are copied on the training thread, the files
+    # are written on a background thread into path.tmp which then replaces path,
+    # so a crash never leaves a half written checkpoint behind
+
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+
+    def save(self, models, state):
+        snapshot = [(name, model.get_weights(), model.optimizer.get_weights()) for name, model in models.items()]
+        state = dict(state, np_random=np.random.get_state())
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(snapshot, state))
+        self.thread.start()
+
+    def write(self, snapshot, state):
+        start = timer()
+        tmp = self.path + ".tmp"
+        old = self.path + ".old"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, weights, optimizer_weights in snapshot:
+            np.savez(os.path.join(tmp, name + ".npz"), *weights)
+            np.savez(os.path.join(tmp, name + ".optimizer.npz"), *optimizer_weights)
+        with open(os.path.join(tmp, "state.pkl"), "wb") as f:
+            pickle.dump(state, f)
+        if os.path.exists(self.path):
+            shutil.rmtree(old, ignore_errors=True)
+            os.replace(self.path, old)
+        os.replace(tmp, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        print("Wrote checkpoint {} in {:.3f}s".format(self.path, timer() - start))
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def latest(self):
+        if os.path.exists(self.path):
+            return self.path
+        # A crash between the two renames of write leaves the previous checkpoint in path.old
+        if os.path.exists(self.path + ".old"):
+            return self.path + ".old"
+        return None
+
+    def restore(self, models):
+        # Loads the last checkpoint into models and returns its training state,
+        # or None when there is no checkpoint
+        path = self.latest()
+        if path is None:
+            return None
+        print("Resuming from checkpoint {} ...".format(path))
+        for name, model in models.items():
+            model.set_weights(load_npz(os.path.join(path, name + ".npz")))
+            optimizer_weights = load_npz(os.path.join(path, name + ".optimizer.npz"))
+            if optimizer_weights:
+                # The optimizer only creates its weights along with the training function
+                model._make_train_function()
+                model.optimizer.set_weights(optimizer_weights)
+        with open(os.path.join(path, "state.pkl"), "rb") as f:
+            state = pickle.load(f)
+        np.random.set_state(state.pop('np_random'))
+        return state
+
+def load_npz(file):
+    with np.load(file) as arrays:
+        return [arrays['arr_' + str(i)] for i in range(len(arrays.files))]
+
 # autoencoder
 
-def generate_sequence_for_encoder(arr, input_vocab_size):
-    c = 0
+def generate_sequence_for_encoder(arr, sampler):
     arr = arr.reshape([-1,config.N_NEIGHBORS])
-    indices = list(range(len(arr)))
-    np.random.shuffle(indices)
-    arr = arr[indices,:]
-    while True:
-        if (c + config.CHUNK_SIZE1 > len(arr)):
-            np.random.shuffle(indices)
-            arr = arr[indices, :]
-            c = 0
-        print("Generating data starting at index {} of length {}".format(c, config.CHUNK_SIZE1))
-        arr_np = np_utils.to_categorical(arr[c:c+config.CHUNK_SIZE1,:].reshape([-1]), num_classes=input_vocab_size).reshape([-1,config.N_NEIGHBORS,input_vocab_size])
-        c = c + config.CHUNK_SIZE1
-        yield arr_np
-
-def get_generators_for_encoder(training_arr, validation_arr, x_vocab_size):
-    training_generator = generate_sequence_for_encoder(training_arr[0], x_vocab_size)
-    eval_generator = generate_sequence_for_encoder(validation_arr[0], x_vocab_size)
-    return (training_generator, eval_generator)
+    for indices in sampler:
+        print("Generating data of epoch {} ending at index {} of length {}".format(sampler.epoch, sampler.position, len(indices)))
+        yield np.asarray(arr[indices], dtype=np.int32)
+
+def get_generators_for_encoder(training_arr, validation_arr, x_vocab_size, start=0, position=None):
+    # start is the number of chunks already trained on, when resuming.
+    # training_arr is either the training arrays or a ShardedCorpus, read from
+    # position if given
+    eval_sampler = ChunkSampler(len(validation_arr[0]) * config.SEQ_LEN, config.CHUNK_SIZE1, results.seed + 1)
+    eval_sampler.seek(start)
+    eval_generator = generate_sequence_for_encoder(validation_arr[0], eval_sampler)
+    if isinstance(training_arr, ShardedCorpus):
+        chunk_records = config.CHUNK_SIZE1 // config.SEQ_LEN
+        training_generator = (x.reshape([-1,config.N_NEIGHBORS]) for x, y in training_arr.chunks(chunk_records, start, position))
+        return (training_generator, eval_generator, training_arr.n_chunks(chunk_records))
+    training_sampler = ChunkSampler(len(training_arr[0]) * config.SEQ_LEN, config.CHUNK_SIZE1, results.seed)
+    training_sampler.seek(start)
+    training_generator = generate_sequence_for_encoder(training_arr[0], training_sampler)
+    return (training_generator, eval_generator, training_sampler.n_chunks())
+
+def one_hot(x, num_classes):
+    from keras import backend as K
+    return K.one_hot(x, num_classes)
+
+def sparse_input(model, input_vocab_size):
+    # Wraps a model taking one-hot (N_NEIGHBORS, vocab) windows so that it takes
+    # the token ids instead. The one-hot vectors only ever exist per batch
+    # inside the graph, never for a whole chunk
+    ids = Input(shape=(config.N_NEIGHBORS,), dtype='int32')
+    return Model(ids, model(Lambda(one_hot, arguments={'num_classes' : input_vocab_size})(ids)))
 
 def create_autoencoder(input_vocab_size):
     inputs = Input(shape=(config.N_NEIGHBORS, input_vocab_size))
@@ -219,85 +647,174 @@ def create_autoencoder(input_vocab_size):
     decoded = LSTM(input_vocab_size, return_sequences=True)(decoded)
     decoded = TimeDistributed(Dense(input_vocab_size, activation='softmax'))(decoded)
 
-    autoencoder = Model(inputs, decoded)
+    # The autoencoder is trained on token ids against sparse targets, the
+    # encoder keeps its one-hot input for the server and the frozen export
+    autoencoder = sparse_input(Model(inputs, decoded), input_vocab_size)
     encoder = Model(inputs, encoded)
     encoder.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
-    autoencoder.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+    autoencoder.compile(loss="sparse_categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
     autoencoder.summary()
     encoder.summary()
     return autoencoder, encoder
 
-def train_encoder_aux(autoencoder, encoder, training_generator, eval_generator, n_chunks):
+def encoder_of(autoencoder):
+    # The encoder sharing its weights with the (sparse-input) autoencoder
+    inner = [layer for layer in autoencoder.layers if isinstance(layer, Model)][0]
+    encoder = Model(inner.input, np_engine.keras_lstm_layer(inner).output)
+    encoder.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+    return encoder
+
+def train_encoder_aux(autoencoder, encoder, training_generator, eval_generator, n_chunks, checkpointer, state, corpus=None):
+    if state['done']:
+        print("Encoder training has already finished")
+        return
     print("Starting encoder training with number of chunks = {} ...".format(n_chunks))
-    counter = 0
-    for j in range(n_chunks):
-        train_data = next(training_generator)
-        eval_data = next(eval_generator)
-        print("Running epoch 1 on data[{}] with train data shape being {}\n".format(j + 1, train_data.shape))
-        print("Running epoch 1 on data[{}] with validation data shape being {}\n".format(j + 1, eval_data.shape))
-        score, acc = autoencoder.evaluate(eval_data, eval_data, batch_size=config.BATCH_SIZE)
-        print("Test score: %.3f, accuracy: %.3f" % (score, acc))
-        if acc > config.ACCURACY:
-            counter += 1
-            if counter >= config.PLATEAU_LEN:
-                autoencoder.save("autoencoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
-                encoder.save("encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
-                return
-        else:
-            counter = 0
-        autoencoder.fit(train_data, train_data, batch_size=config.BATCH_SIZE, epochs=1, validation_data=(eval_data, eval_data))
-        if j % 10 == 0:
-            autoencoder.save("autoencoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
-            encoder.save("encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
+    counter = state['counter']
+    pipeline = Prefetcher(zip(training_generator, eval_generator), config.PREFETCH_DEPTH)
+    try:
+        for j in range(state['chunks'], n_chunks):
+            train_data, eval_data = next(pipeline)
+            print("Running epoch 1 on data[{}] with train data shape being {}\n".format(j + 1, train_data.shape))
+            print("Running epoch 1 on data[{}] with validation data shape being {}\n".format(j + 1, eval_data.shape))
+            score, acc = autoencoder.evaluate(eval_data, eval_data[..., None], batch_size=config.BATCH_SIZE)
+            print("Test score: %.3f, accuracy: %.3f" % (score, acc))
+            if acc > config.ACCURACY:
+                counter += 1
+                if counter >= config.PLATEAU_LEN:
+                    break
+            else:
+                counter = 0
+            autoencoder.fit(train_data, train_data[..., None], batch_size=config.BATCH_SIZE, epochs=1, validation_data=(eval_data, eval_data[..., None]))
+            if (j + 1) % config.CHECKPOINT_EVERY == 0:
+                checkpointer.save({'autoencoder' : autoencoder}, {'chunks' : j + 1, 'counter' : counter, 'done' : False,
+                                                                   'stream' : stream_position(corpus, j + 1)})
+    finally:
+        pipeline.close()
+    checkpointer.wait()
+    # The encoded LSTM inputs are cached by the hash of the encoder file, so it has to hold the final weights
+    autoencoder.save("autoencoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
+    encoder.save("encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
+    checkpointer.save({'autoencoder' : autoencoder}, {'chunks' : n_chunks, 'counter' : counter, 'done' : True})
+    checkpointer.wait()
 
 def train_encoder(training_arr, validation_arr, input_vocab_size):
-    training_generator, eval_generator = get_generators_for_encoder(training_arr, validation_arr, input_vocab_size)
-    autoencoder, encoder = load_or_create_encoder(input_vocab_size)
-    train_encoder_aux(autoencoder, encoder, training_generator, eval_generator, int(len(training_arr[0].reshape([-1,config.N_NEIGHBORS])) / config.CHUNK_SIZE1))
+    checkpointer = Checkpointer(config.CHECKPOINT_DIR + ".encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE))
+    autoencoder, encoder = load_or_create_encoder(input_vocab_size, checkpointer)
+    state = None
+    if results.load_model1:
+        state = checkpointer.restore({'autoencoder' : autoencoder})
+    if state is None:
+        state = {'chunks' : 0, 'counter' : 0, 'done' : False}
+    training_generator, eval_generator, n_chunks = get_generators_for_encoder(training_arr, validation_arr, input_vocab_size,
+                                                                              state['chunks'], state.get('stream'))
+    train_encoder_aux(autoencoder, encoder, training_generator, eval_generator, n_chunks, checkpointer, state, training_arr)
     return autoencoder, encoder
 
-def load_or_create_encoder(x_vocab_size):
-    if results.load_model1:
+def load_or_create_encoder(x_vocab_size, checkpointer):
+    if results.load_model1 and checkpointer.latest() is None:
         print("Loading encoder model ...")
         autoencoder = load_model("autoencoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
-        encoder = load_model("encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
+        if len(autoencoder.input_shape) == 3:
+            print("Converting one-hot input autoencoder to token id inputs (optimizer state is reset) ...")
+            autoencoder = sparse_input(autoencoder, x_vocab_size)
+            autoencoder.compile(loss="sparse_categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+        encoder = encoder_of(autoencoder)
     else:
+        # When resuming, the weights are restored from the checkpoint into the new model
         print("Creating encoder model ...")
         autoencoder, encoder = create_autoencoder(x_vocab_size)
     return autoencoder, encoder
 
 ########  LSTM for actual variable name output
 
-def generate_sequence_for_lstm(encoder, arr, input_vocab_size, output_vocab_size):
-    c = 0
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def array_hash(arr):
+    # Hash of the shape, dtype and contents of a (memory-mapped) array, read
+    # CHUNK_SIZE2 rows at a time
+    h = hashlib.sha1("{} {}".format(arr.shape, arr.dtype).encode())
+    for c in range(0, len(arr), config.CHUNK_SIZE2):
+        h.update(np.ascontiguousarray(arr[c:c+config.CHUNK_SIZE2]).tobytes())
+    return h.hexdigest()
+
+def encode_cached(encoder, arr, name, input_vocab_size, encoder_file):
+    # The encoder is frozen while the LSTM trains, so every context is encoded
+    # once into a memory-mapped (N, SEQ_LEN, HIDDEN_LAYER_SIZE) array on disk.
+    # The file name carries the hashes of the encoder file and of the contexts,
+    # a retrained encoder or reprocessed data gets a new cache and the stale
+    # ones are removed
+    prefix = config.ENCODED_FILE + "_" + name + "."
+    path = prefix + file_hash(encoder_file)[:16] + "_" + array_hash(arr)[:16] + ".npy"
+    if os.path.exists(path):
+        print("Using encoder outputs cached in {}".format(path))
+        cached = np.load(path, mmap_mode='r')
+        if len(cached) != len(arr):
+            raise ValueError("{} holds {} encoded contexts, expected {}".format(path, len(cached), len(arr)))
+        return cached
+    for stale in glob.glob(prefix + "*.npy"):
+        os.remove(stale)
+
+    print("Encoding {} contexts into {} ...".format(len(arr), path))
+    sparse_encoder = sparse_input(encoder, input_vocab_size)
+    out = np.lib.format.open_memmap(path + ".tmp", mode='w+', dtype=config.ENCODED_DTYPE,
+                                    shape=(len(arr), config.SEQ_LEN, config.HIDDEN_LAYER_SIZE))
+    for c in range(0, len(arr), config.CHUNK_SIZE2):
+        i_slice = np.asarray(arr[c:c+config.CHUNK_SIZE2,:])
+        out[c:c+config.CHUNK_SIZE2] = sparse_encoder.predict(i_slice.reshape([-1,config.N_NEIGHBORS])).reshape([-1,config.SEQ_LEN,config.HIDDEN_LAYER_SIZE])
+    out.flush()
+    del out
+    os.replace(path + ".tmp", path)
+    return np.load(path, mmap_mode='r')
+
+def one_hot_targets(ids, output_vocab_size):
+    return np_utils.to_categorical(ids, num_classes=output_vocab_size)
+
+def generate_sequence_for_lstm(arr, sampler):
+    # arr holds the cached encoder outputs and the output ids. The targets are
+    # yielded as ids and one-hot encoded by the training loop (see
+    # one_hot_targets), as a prefetched (CHUNK_SIZE2, OUTPUT_VOCAB_SIZE)
+    # float32 chunk takes GBs
     input = arr[0]
     output = arr[1]
-    length = len(input)
-    indices = list(range(length))
-    np.random.shuffle(indices)
-    input = input[indices,:]
-    output = output[indices]
-
-    while True:
-        if (c + config.CHUNK_SIZE2 > length):
-            np.random.shuffle(indices)
-            input = input[indices, :]
-            output = output[indices]
-            c = 0
-        i_slice = input[c:c+config.CHUNK_SIZE2,:]
-        i_slice = np_utils.to_categorical(i_slice.reshape([-1]), num_classes=input_vocab_size).reshape([-1,config.N_NEIGHBORS,input_vocab_size])
-        i_encoded_slice = encoder.predict(i_slice)
-        i_slice = i_encoded_slice.reshape([-1,config.SEQ_LEN,config.HIDDEN_LAYER_SIZE])
-        o_slice = output[c:c+config.CHUNK_SIZE2]
-        o_slice = np_utils.to_categorical(o_slice, num_classes=output_vocab_size)
-        c = c + config.CHUNK_SIZE2
+    for indices in sampler:
+        i_slice = np.asarray(input[indices], dtype=np.float32)
+        o_slice = np.asarray(output[indices])
         print("i_slice.shape = {} o_slice.shape {}".format(i_slice.shape, o_slice.shape))
         yield (i_slice, o_slice)
 
-def get_generators_for_lstm(encoder, training_arr, validation_arr, input_vocab_size, output_vocab_size):
-    training_generator = generate_sequence_for_lstm(encoder, training_arr, input_vocab_size, output_vocab_size)
-    eval_generator = generate_sequence_for_lstm(encoder, validation_arr, input_vocab_size, output_vocab_size)
-    return (training_generator, eval_generator)
+def stream_for_lstm(encoder, corpus, input_vocab_size, start, position=None):
+    # Encodes every chunk streamed from corpus, there is no cache to look the
+    # encoder outputs up in. The predict function is built here, on the
+    # training thread, as building it on the prefetching thread would put it in
+    # another graph
+    sparse_encoder = sparse_input(encoder, input_vocab_size)
+    sparse_encoder._make_predict_function()
+    def generate():
+        for x, y in corpus.chunks(config.CHUNK_SIZE2, start, position):
+            i_slice = sparse_encoder.predict(x.reshape([-1,config.N_NEIGHBORS])).reshape([-1,config.SEQ_LEN,config.HIDDEN_LAYER_SIZE])
+            yield (i_slice, y)
+    return generate()
+
+def get_generators_for_lstm(encoder, training_arr, validation_arr, input_vocab_size, start=0, position=None):
+    # training_arr is either the training arrays or a ShardedCorpus
+    encoder_file = "encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE
+    validation_encoded = encode_cached(encoder, validation_arr[0], "validation", input_vocab_size, encoder_file)
+    eval_sampler = ChunkSampler(len(validation_encoded), config.CHUNK_SIZE2, results.seed + 1)
+    eval_sampler.seek(start)
+    eval_generator = generate_sequence_for_lstm((validation_encoded, validation_arr[1]), eval_sampler)
+    if isinstance(training_arr, ShardedCorpus):
+        training_generator = stream_for_lstm(encoder, training_arr, input_vocab_size, start, position)
+        return (training_generator, eval_generator, training_arr.n_chunks(config.CHUNK_SIZE2))
+    training_encoded = encode_cached(encoder, training_arr[0], "training", input_vocab_size, encoder_file)
+    training_sampler = ChunkSampler(len(training_encoded), config.CHUNK_SIZE2, results.seed)
+    training_sampler.seek(start)
+    training_generator = generate_sequence_for_lstm((training_encoded, training_arr[1]), training_sampler)
+    return (training_generator, eval_generator, training_sampler.n_chunks())
 
 def create_lstm(output_vocab_size):
     inputs = Input(shape=(config.SEQ_LEN, config.HIDDEN_LAYER_SIZE))
@@ -312,47 +829,485 @@ def create_lstm(output_vocab_size):
     lstm.summary()
     return (embedding, lstm)
 
-def load_or_create_lstm(output_vocab_size):
-    if results.load_model2:
+class SampledSoftmaxLoss(Layer):
+    # Per-sample sampled softmax loss of the output layer dense, given its input
+    # and the integer targets. The kernel and bias of dense are trained through
+    # this layer, so the full softmax model keeps the trained weights
+
+    def __init__(self, dense, num_sampled, **kwargs):
+        self.dense = dense
+        self.num_sampled = num_sampled
+        Layer.__init__(self, **kwargs)
+
+    def build(self, input_shape):
+        weights = [self.dense.kernel, self.dense.bias]
+        if hasattr(self, '_trainable_weights'):
+            self._trainable_weights = weights
+        else:
+            self.trainable_weights = weights
+        Layer.build(self, input_shape)
+
+    def call(self, inputs):
+        import tensorflow as tf
+        hidden, labels = inputs
+        loss = tf.nn.sampled_softmax_loss(weights=tf.transpose(self.dense.kernel), biases=self.dense.bias,
+                                          labels=tf.cast(labels, tf.int64), inputs=hidden,
+                                          num_sampled=self.num_sampled, num_classes=self.dense.units)
+        return K.expand_dims(loss, -1)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0][0], 1)
+
+def identity_loss(y_true, y_pred):
+    return K.mean(y_pred, axis=-1)
+
+def create_sampled_trainer(lstm, num_sampled):
+    # Training model sharing the LSTM and output layer weights of lstm, taking
+    # the encoded contexts and the integer targets and returning the loss
+    if K.backend() != 'tensorflow':
+        raise ValueError("Sampled softmax training requires the TensorFlow backend")
+    dense = np_engine.keras_dense_layer(lstm)
+    labels = Input(shape=(1,), dtype='int64')
+    loss = SampledSoftmaxLoss(dense, num_sampled)([dense.input, labels])
+    trainer = Model([lstm.input, labels], loss)
+    trainer.compile(loss=identity_loss, optimizer="adam")
+    return trainer
+
+def evaluate_sparse(model, x, y):
+    # Full softmax loss and accuracy of model against integer targets,
+    # predicted in batches so that only (EVAL_BATCH_SIZE, vocab) probabilities exist at a time
+    loss = 0.0
+    correct = 0
+    for c in range(0, len(x), config.EVAL_BATCH_SIZE):
+        probs = model.predict(x[c:c+config.EVAL_BATCH_SIZE], batch_size=config.BATCH_SIZE)
+        t = y[c:c+config.EVAL_BATCH_SIZE]
+        loss -= float(np.sum(np.log(np.maximum(probs[np.arange(len(t)), t], 1e-7))))
+        correct += int(np.sum(np.argmax(probs, axis=1) == t))
+    return loss / max(len(x), 1), correct / float(max(len(x), 1))
+
+def load_or_create_lstm(output_vocab_size, checkpointer):
+    if results.load_model2 and checkpointer.latest() is None:
         print("Loading lstm model")
         embedding = load_model("embedding_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
         lstm = load_model("lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
     else:
+        # When resuming, the weights are restored from the checkpoint into the new model
         print("Creating lstm model with output vocab size {}".format(output_vocab_size))
         embedding, lstm = create_lstm(output_vocab_size)
     return embedding, lstm
 
 
 
-def train_lstm_aux(embedding, lstm, training_generator, eval_generator, n_chunks, o_index2word):
+def train_lstm_aux(embedding, lstm, training_generator, eval_generator, n_chunks, o_index2word, checkpointer, models, start=0, trainer=None, corpus=None):
+    # start is the number of chunks already trained on, over all epochs
     print("Starting lstm training ...")
+    lines = []
+    if start > 0 and os.path.exists("history.csv"):
+        # Drop the scores of chunks trained after the checkpoint
+        with open("history.csv") as myfile:
+            lines = myfile.readlines()[:start]
     with open("history.csv", "w") as myfile:
-        myfile.write("")
+        myfile.write("".join(lines))
 
-    for i in range(config.NUM_EPOCHS):
-        for j in range(n_chunks):
-            train_data = next(training_generator)
-            eval_data = next(eval_generator)
+    output_vocab_size = lstm.output_shape[-1]
+    pipeline = Prefetcher(zip(training_generator, eval_generator), config.PREFETCH_DEPTH)
+    try:
+        for c in range(start, config.NUM_EPOCHS * n_chunks):
+            i, j = divmod(c, n_chunks)
+            train_data, eval_data = next(pipeline)
             print("Running epoch {} on data[{}] with train data shape being {} {}\n".format(i + 1, j + 1,
                                                                                          train_data[0].shape, train_data[1].shape))
-            history = lstm.fit(train_data[0], train_data[1], batch_size=config.BATCH_SIZE, epochs=1,
-                            validation_data=(eval_data[0], eval_data[1]))
+            if trainer is None:
+                # The one-hot targets only live for the duration of the fit
+                history = lstm.fit(train_data[0], one_hot_targets(train_data[1], output_vocab_size), batch_size=config.BATCH_SIZE, epochs=1,
+                                validation_data=(eval_data[0], one_hot_targets(eval_data[1], output_vocab_size)))
+                scores = (history.history['loss'].pop(), history.history['acc'].pop(), history.history['val_loss'].pop(), history.history['val_acc'].pop())
+            else:
+                # The training loss is the sampled one, validation uses the full softmax
+                history = trainer.fit([train_data[0], train_data[1][:,None]], np.zeros([len(train_data[1]), 1]),
+                                      batch_size=config.BATCH_SIZE, epochs=1)
+                val_loss, val_acc = evaluate_sparse(lstm, eval_data[0], eval_data[1])
+                print("Validation (full softmax) loss: %.3f, accuracy: %.3f" % (val_loss, val_acc))
+                scores = (history.history['loss'].pop(), float('nan'), val_loss, val_acc)
 
             with open("history.csv", "a") as myfile:
-                myfile.write("{} {} {} {}\n".format(history.history['loss'].pop(), history.history['acc'].pop(), history.history['val_loss'].pop(), history.history['val_acc'].pop()))
-            if j%10 == 0:
-                embedding.save("embedding_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(
-                    config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
-                lstm.save("lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(
-                    config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
+                myfile.write("{} {} {} {}\n".format(*scores))
+            if (c + 1) % config.CHECKPOINT_EVERY == 0:
+                checkpointer.save(models, {'chunks' : c + 1, 'done' : False, 'stream' : stream_position(corpus, c + 1)})
+    finally:
+        pipeline.close()
+    checkpointer.wait()
+    embedding.save("embedding_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(
+        config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
+    lstm.save("lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(
+        config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
+    checkpointer.save(models, {'chunks' : config.NUM_EPOCHS * n_chunks, 'done' : True})
+    checkpointer.wait()
 
 def train_lstm(encoder, training_arr, validation_arr, i_map, o_map):
-    training_generator, eval_generator = get_generators_for_lstm(encoder, training_arr, validation_arr, i_map[0], o_map[0])
-    embedding, lstm = load_or_create_lstm(o_map[0])
-    train_lstm_aux(embedding, lstm, training_generator, eval_generator, int(len(training_arr[0]) / config.CHUNK_SIZE2), o_map[2])
+    checkpointer = Checkpointer(config.CHECKPOINT_DIR + ".lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE))
+    embedding, lstm = load_or_create_lstm(o_map[0], checkpointer)
+    trainer = None
+    models = {'lstm' : lstm}
+    if results.num_sampled > 0:
+        print("Training the output layer with a sampled softmax over {} words".format(results.num_sampled))
+        trainer = create_sampled_trainer(lstm, results.num_sampled)
+        models['trainer'] = trainer
+    state = None
+    if results.load_model2:
+        state = checkpointer.restore(models)
+    if state is None:
+        state = {'chunks' : 0, 'done' : False}
+    if state['done']:
+        print("LSTM training has already finished")
+        return
+    training_generator, eval_generator, n_chunks = get_generators_for_lstm(encoder, training_arr, validation_arr, i_map[0],
+                                                                           state['chunks'], state.get('stream'))
+    train_lstm_aux(embedding, lstm, training_generator, eval_generator, n_chunks, o_map[2], checkpointer, models,
+                   state['chunks'], trainer, training_arr)
 
-def load_and_train_lstm():
+# Knowledge distillation. The student is a smaller encoder and LSTM of the
+# same structure as the teacher's, trained end to end from the token ids on
+# the renormalized top-k output probabilities of the teacher and the true output
+
+def predict_topk(model, x, k):
+    # Top-k (probabilities, ids) of the softmax output of model, best first,
+    # predicted in batches of EVAL_BATCH_SIZE rows
+    probs = np.empty([len(x), k], dtype=np.float32)
+    ids = np.empty([len(x), k], dtype=np.int64)
+    for c in range(0, len(x), config.EVAL_BATCH_SIZE):
+        p = model.predict(x[c:c+config.EVAL_BATCH_SIZE], batch_size=config.BATCH_SIZE)
+        top = np.argpartition(-p, k, axis=1)[:,:k]
+        top_p = np.take_along_axis(p, top, axis=1)
+        order = np.argsort(-top_p, axis=1)
+        probs[c:c+config.EVAL_BATCH_SIZE] = np.take_along_axis(top_p, order, axis=1)
+        ids[c:c+config.EVAL_BATCH_SIZE] = np.take_along_axis(top, order, axis=1)
+    return probs, ids
+
+def distillation_loss(y_true, y_pred):
+    # y_true packs the teacher's top-k ids, their probabilities and the true output id
+    k = config.DISTILL_TOP_K
+    log_q = K.log(K.clip(y_pred, K.epsilon(), 1.0))
+    # Row r of the flattened log probabilities starts at r * vocab
+    offsets = K.expand_dims(K.arange(0, K.shape(y_pred)[0]) * K.shape(y_pred)[1], -1)
+    flat = K.reshape(log_q, (-1,))
+    soft = -K.sum(y_true[:,k:2*k] * K.gather(flat, K.cast(y_true[:,:k], 'int32') + offsets), axis=-1)
+    hard = -K.gather(flat, K.cast(y_true[:,2*k:], 'int32') + offsets)[:,0]
+    return config.DISTILL_ALPHA * hard + (1 - config.DISTILL_ALPHA) * soft
+
+def distilled_accuracy(y_true, y_pred):
+    return K.cast(K.equal(K.cast(K.argmax(y_pred, axis=-1), K.floatx()), y_true[:,-1]), K.floatx())
+
+def stack_on_ids(encoder, lstm, input_vocab_size):
+    # Returns an input of the token ids of whole contexts and the output of lstm
+    # on the encoder outputs of its SEQ_LEN windows, all in one graph
+    ids = Input(shape=(config.SEQ_LEN * config.N_NEIGHBORS,), dtype='int32')
+    windows = Reshape((config.SEQ_LEN, config.N_NEIGHBORS))(ids)
+    one_hots = Lambda(one_hot, arguments={'num_classes' : input_vocab_size})(windows)
+    return ids, lstm(TimeDistributed(encoder)(one_hots))
+
+def create_student(input_vocab_size, output_vocab_size):
+    # Returns the end to end training model on the token ids of a context and
+    # the student encoder and LSTM, saved and served like the teacher's
+    window = Input(shape=(config.N_NEIGHBORS, input_vocab_size))
+    encoder = Model(window, LSTM(config.STUDENT_HIDDEN_LAYER_SIZE)(window))
+    inputs = Input(shape=(config.SEQ_LEN, config.STUDENT_HIDDEN_LAYER_SIZE))
+    lstm = Model(inputs, Dense(output_vocab_size, activation='softmax')(LSTM(config.STUDENT_HIDDEN_LAYER_SIZE2)(inputs)))
+
+    student = Model(*stack_on_ids(encoder, lstm, input_vocab_size))
+
+    encoder.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+    lstm.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
+    student.compile(loss=distillation_loss, optimizer="adam", metrics=[distilled_accuracy])
+    student.summary()
+    return student, encoder, lstm
+
+def generate_sequence_for_distillation(teacher_lstm, graph, arr, sampler):
+    # arr holds the token ids, the cached teacher encoder outputs and the output
+    # ids. Yields the token ids and the packed targets of distillation_loss. The
+    # teacher runs on the prefetching thread, in the graph it was loaded in
+    ids, encoded, output = arr
+    for indices in sampler:
+        with graph.as_default():
+            probs, top = predict_topk(teacher_lstm, np.asarray(encoded[indices], dtype=np.float32), config.DISTILL_TOP_K)
+        probs /= np.maximum(probs.sum(axis=1, keepdims=True), 1e-7)
+        targets = np.concatenate([top, probs, np.asarray(output[indices])[:,None]], axis=1).astype(np.float32)
+        yield np.asarray(ids[indices], dtype=np.int32), targets
+
+def pipeline_topk(encoder, lstm, ctx, k):
+    # encoder takes token ids, as in the server
+    encoded = encoder.predict(ctx.reshape([-1,config.N_NEIGHBORS]), batch_size=config.EVAL_BATCH_SIZE)
+    return predict_topk(lstm, encoded.reshape([len(ctx),config.SEQ_LEN,-1]), k)
+
+def compare_student(models, validation_arr, input_vocab_size):
+    # models maps a name to its (encoder, lstm). Prints the top-1 and top-10
+    # accuracy on the first DISTILL_EVAL_SIZE validation records, the throughput,
+    # and the latency of predicting a single variable
+    ctx = np.asarray(validation_arr[0][:config.DISTILL_EVAL_SIZE])
+    truth = np.asarray(validation_arr[1][:config.DISTILL_EVAL_SIZE])
+    total = float(max(len(ctx), 1))
+    for name, (encoder, lstm) in models.items():
+        sparse_encoder = sparse_input(encoder, input_vocab_size)
+        start = timer()
+        _, ids = pipeline_topk(sparse_encoder, lstm, ctx, 10)
+        elapsed = timer() - start
+        start = timer()
+        for r in range(config.LATENCY_RUNS):
+            pipeline_topk(sparse_encoder, lstm, ctx[r % len(ctx):][:1], 10)
+        latency = (timer() - start) / config.LATENCY_RUNS
+        print("{}: top-1 accuracy {:.4f}, top-10 accuracy {:.4f}, {:.1f} variables/s, {:.2f} ms per single variable".format(
+            name, np.sum(ids[:,0] == truth) / total, np.sum(np.any(ids == truth[:,None], axis=1)) / total,
+            len(ctx) / max(elapsed, 1e-9), latency * 1000))
+
+def distill():
     training_arr, validation_arr, i_map, o_map = load_and_process_arrays()
+    encoder_file = "encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE
+    teacher_encoder = load_model(encoder_file)
+    teacher_lstm = load_model("lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
+    training_encoded = encode_cached(teacher_encoder, training_arr[0], "training", i_map[0], encoder_file)
+    validation_encoded = encode_cached(teacher_encoder, validation_arr[0], "validation", i_map[0], encoder_file)
+
+    student, student_encoder, student_lstm = create_student(i_map[0], o_map[0])
+    teacher_lstm._make_predict_function()
+    graph = K.get_session().graph
+    training_sampler = ChunkSampler(len(training_encoded), config.CHUNK_SIZE2, results.seed)
+    eval_sampler = ChunkSampler(len(validation_encoded), config.CHUNK_SIZE2, results.seed + 1)
+    training_generator = generate_sequence_for_distillation(teacher_lstm, graph, (training_arr[0], training_encoded, training_arr[1]), training_sampler)
+    eval_generator = generate_sequence_for_distillation(teacher_lstm, graph, (validation_arr[0], validation_encoded, validation_arr[1]), eval_sampler)
+
+    encoder_out = "student_encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.STUDENT_HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE
+    lstm_out = "student_lstm_" + str(config.STUDENT_HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE
+    n_chunks = training_sampler.n_chunks()
+    print("Starting student training ...")
+    pipeline = Prefetcher(zip(training_generator, eval_generator), config.PREFETCH_DEPTH)
+    try:
+        for c in range(config.NUM_EPOCHS * n_chunks):
+            i, j = divmod(c, n_chunks)
+            train_data, eval_data = next(pipeline)
+            print("Running epoch {} on data[{}] with train data shape being {} {}\n".format(i + 1, j + 1, train_data[0].shape, train_data[1].shape))
+            student.fit(train_data[0], train_data[1], batch_size=config.BATCH_SIZE, epochs=1, validation_data=eval_data)
+            if (c + 1) % config.CHECKPOINT_EVERY == 0:
+                student_encoder.save(encoder_out)
+                student_lstm.save(lstm_out)
+    finally:
+        pipeline.close()
+    student_encoder.save(encoder_out)
+    student_lstm.save(lstm_out)
+    print("Saved the student models to {} and {}".format(encoder_out, lstm_out))
+
+    compare_student(collections.OrderedDict([('teacher', (teacher_encoder, teacher_lstm)), ('student', (student_encoder, student_lstm))]),
+                    validation_arr, i_map[0])
+
+def export_frozen():
+    encoder = load_model("encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
+    lstm = load_model("lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
+    path = config.FROZEN_DIR + "_" + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE)
+    print("Exporting frozen models to {} ...".format(path))
+    np_engine.freeze(path, encoder, lstm)
+
+    frozen = np_engine.FrozenModel.load(path)
+    encoder_diff, prob_diff, mismatch = np_engine.check_frozen(frozen, encoder, lstm, encoder.input_shape[-1],
+                                                               config.N_NEIGHBORS, config.SEQ_LEN)
+    print("Max encoder difference: {}, max top-k probability difference: {}, top-k mismatches: {}".format(encoder_diff, prob_diff, mismatch))
+    if encoder_diff > config.FROZEN_TOLERANCE or prob_diff > config.FROZEN_TOLERANCE:
+        print("Frozen models do not match the Keras models!")
+        sys.exit(1)
+
+def top_k(x, k):
+    # The k largest entries of every row and their indices, best first, packed
+    # into one (N, 2 * k) float tensor. Ties go to the smaller index
+    import tensorflow as tf
+    values, indices = tf.nn.top_k(x, k)
+    return tf.concat([values, tf.cast(indices, x.dtype)], axis=-1)
+
+def export_fused():
+    # The served models run as one Keras model from the (N, SEQ_LEN * N_NEIGHBORS)
+    # token ids of the contexts to their top-k output probabilities and ids
+    if K.backend() != 'tensorflow':
+        raise ValueError("The fused export requires the TensorFlow backend")
+    encoder = load_model("encoder." + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE) + "." + config.MODEL_FILE)
+    lstm = load_model("lstm_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE)
+    input_vocab_size = encoder.input_shape[-1]
+    ids, probs = stack_on_ids(encoder, lstm, input_vocab_size)
+    fused = Model(ids, Lambda(top_k, arguments={'k' : config.FUSED_TOP_K}, output_shape=(2 * config.FUSED_TOP_K,))(probs))
+    fused.compile(loss="mse", optimizer="adam")
+    path = config.FUSED_FILE + "_" + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE) + "." + config.MODEL_FILE
+    print("Exporting fused model to {} ...".format(path))
+    fused.save(path)
+
+    fused = load_model(path)
+    ctx = np.random.RandomState(0).randint(0, input_vocab_size, size=[256, config.SEQ_LEN * config.N_NEIGHBORS]).astype(np.int32)
+    out = fused.predict(ctx)
+    probs, top = pipeline_topk(sparse_input(encoder, input_vocab_size), lstm, ctx, config.FUSED_TOP_K)
+    prob_diff = float(np.abs(out[:,:config.FUSED_TOP_K] - probs).max())
+    mismatch = float(np.mean(np.any(np.sort(out[:,config.FUSED_TOP_K:].astype(np.int64), axis=1) != np.sort(top, axis=1), axis=1)))
+    print("Max top-k probability difference: {}, top-k mismatches: {}".format(prob_diff, mismatch))
+    if prob_diff > config.FROZEN_TOLERANCE:
+        print("The fused model does not match the Keras models!")
+        sys.exit(1)
+
+def frozen_predict_topk(frozen, ctx, k):
+    encoded = frozen.encoder.predict(ctx.reshape([-1,config.N_NEIGHBORS]))
+    return frozen.lstm.predict_topk(encoded.reshape([-1,config.SEQ_LEN,config.HIDDEN_LAYER_SIZE]), k)
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+def evaluate_quantized(mode):
+    src = config.FROZEN_DIR + "_" + str(config.INPUT_VOCAB_SIZE) + "_" + str(config.HIDDEN_LAYER_SIZE2) + "_" + str(config.OUTPUT_VOCAB_SIZE)
+    dst = src + "_" + mode
+    print("Quantizing {} to {} ({}) ...".format(src, dst, mode))
+    np_engine.quantize_frozen(src, dst, mode)
+
+    i_map = vocab.load_map("i_"+str(config.INPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE)
+    o_map = vocab.load_map("o_"+str(config.OUTPUT_VOCAB_SIZE)+"_"+config.PROCESSED_FILE)
+    ctx, truth = load_inputs(config.EVAL_FILE, i_map, o_map)
+
+    models = [np_engine.FrozenModel.load(src), np_engine.FrozenModel.load(dst)]
+    top1 = [0, 0]
+    top10 = [0, 0]
+    agree = 0
+    for c in range(0, len(ctx), config.EVAL_BATCH_SIZE):
+        t = truth[c:c+config.EVAL_BATCH_SIZE]
+        best = []
+        for n, model in enumerate(models):
+            _, ids = frozen_predict_topk(model, ctx[c:c+config.EVAL_BATCH_SIZE], 10)
+            top1[n] += int(np.sum(ids[:,0] == t))
+            top10[n] += int(np.sum(np.any(ids == t[:,None], axis=1)))
+            best.append(ids[:,0])
+        agree += int(np.sum(best[0] == best[1]))
+
+    total = float(max(len(ctx), 1))
+    print("Size: float32 {:.1f} MB, {} {:.1f} MB".format(dir_size(src) / 2.0**20, mode, dir_size(dst) / 2.0**20))
+    print("Top-1 accuracy: float32 {:.4f}, {} {:.4f}, delta {:+.4f}".format(top1[0] / total, mode, top1[1] / total, (top1[1] - top1[0]) / total))
+    print("Top-10 accuracy: float32 {:.4f}, {} {:.4f}, delta {:+.4f}".format(top10[0] / total, mode, top10[1] / total, (top10[1] - top10[0]) / total))
+    print("Top-1 agreement: {:.4f}".format(agree / total))
+
+def write_synthetic_corpus(path, n_records, seed):
+    # Records in the format written by c2n_client.js, with Zipf distributed
+    # context tokens and names so that both vocabularies have a long tail
+    rng = np.random.RandomState(seed)
+    req = config.SEQ_LEN * config.N_NEIGHBORS
+    with open(path, "w") as f:
+        for i in range(n_records):
+            context = rng.zipf(1.3, size=rng.randint(req // 2, req + 1)) % (2 * config.INPUT_VOCAB_SIZE)
+            name = rng.zipf(1.3) % (2 * config.OUTPUT_VOCAB_SIZE)
+            f.write("file{}.js 1ID:0:v{} {}\n".format(i // 100, name, " ".join("t" + str(t) for t in context)))
+
+def git_commit():
+    # The commit the benchmarked code is at, and whether it has local changes
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=cwd, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd, stderr=subprocess.DEVNULL).strip() != b""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def benchmark(n_chunks):
+    # Runs every training stage synchronously over n_chunks chunks of
+    # CHUNK_SIZE2 records and writes the seconds spent in each stage and the
+    # throughput of the models to BENCHMARK_FILE, to be compared across commits
+    os.makedirs(config.BENCHMARK_DIR, exist_ok=True)
+    corpus = os.path.join(config.BENCHMARK_DIR, "corpus.csv")
+    n_records = n_chunks * config.CHUNK_SIZE2
+    if results.benchmark_corpus:
+        with open(results.benchmark_corpus, "r") as src, open(corpus, "w") as dst:
+            dst.writelines(itertools.islice(src, n_records))
+    else:
+        write_synthetic_corpus(corpus, n_records, results.seed)
+
+    stages = collections.OrderedDict()
+    samples = collections.OrderedDict()
+    start = timer()
+    i_freqs, o_freqs = count_tokens(corpus)
+    i_map = get_word2index(config.INPUT_VOCAB_SIZE, i_freqs)
+    o_map = get_word2index(config.OUTPUT_VOCAB_SIZE, o_freqs, config.KTH_COMMON)
+    stages['loading'] = timer() - start
+
+    start = timer()
+    arr = load_inputs(corpus, i_map, o_map)
+    stages['indexify'] = timer() - start
+
+    autoencoder, encoder = create_autoencoder(i_map[0])
+    generator = generate_sequence_for_encoder(arr[0], ChunkSampler(len(arr[0]) * config.SEQ_LEN, config.CHUNK_SIZE1, results.seed))
+    stages['encoder_fit'] = 0.0
+    samples['encoder_fit'] = 0
+    for j in range(n_chunks):
+        data = next(generator)
+        start = timer()
+        autoencoder.fit(data, data[..., None], batch_size=config.BATCH_SIZE, epochs=1, verbose=0)
+        stages['encoder_fit'] += timer() - start
+        samples['encoder_fit'] += len(data)
+
+    sparse_encoder = sparse_input(encoder, i_map[0])
+    encoded = np.empty([len(arr[0]), config.SEQ_LEN, config.HIDDEN_LAYER_SIZE], dtype=config.ENCODED_DTYPE)
+    start = timer()
+    for c in range(0, len(arr[0]), config.CHUNK_SIZE2):
+        encoded[c:c+config.CHUNK_SIZE2] = sparse_encoder.predict(arr[0][c:c+config.CHUNK_SIZE2].reshape([-1,config.N_NEIGHBORS])).reshape([-1,config.SEQ_LEN,config.HIDDEN_LAYER_SIZE])
+    stages['encoder_predict'] = timer() - start
+    samples['encoder_predict'] = len(arr[0]) * config.SEQ_LEN
+
+    embedding, lstm = create_lstm(o_map[0])
+    models = {'lstm' : lstm}
+    if results.num_sampled > 0:
+        models['trainer'] = create_sampled_trainer(lstm, results.num_sampled)
+    # Only the full softmax targets are one-hot encoded
+    generator = generate_sequence_for_lstm((encoded, arr[1]), ChunkSampler(len(encoded), config.CHUNK_SIZE2, results.seed))
+    stages['one_hot'] = 0.0
+    stages['lstm_fit'] = 0.0
+    samples['lstm_fit'] = 0
+    for j in range(n_chunks):
+        start = timer()
+        x, y = next(generator)
+        if results.num_sampled == 0:
+            y = one_hot_targets(y, o_map[0])
+        stages['one_hot'] += timer() - start
+        start = timer()
+        if results.num_sampled > 0:
+            models['trainer'].fit([x, y[:,None]], np.zeros([len(y), 1]), batch_size=config.BATCH_SIZE, epochs=1, verbose=0)
+        else:
+            lstm.fit(x, y, batch_size=config.BATCH_SIZE, epochs=1, verbose=0)
+        stages['lstm_fit'] += timer() - start
+        samples['lstm_fit'] += len(x)
+
+    # The snapshot blocks training, the write runs in the background
+    checkpointer = Checkpointer(os.path.join(config.BENCHMARK_DIR, "checkpoint"))
+    start = timer()
+    checkpointer.save(models, {'chunks' : n_chunks})
+    stages['checkpoint'] = timer() - start
+    start = timer()
+    checkpointer.wait()
+    stages['checkpoint_write'] = timer() - start
+
+    commit, dirty = git_commit()
+    report = collections.OrderedDict([
+        ('commit', commit),
+        ('dirty', dirty),
+        ('time', time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ('corpus', results.benchmark_corpus or "synthetic"),
+        ('chunks', n_chunks),
+        ('records', len(arr[0])),
+        ('sampled_softmax', results.num_sampled),
+        ('backend', K.backend()),
+        ('stages', stages),
+        ('samples_per_sec', collections.OrderedDict((name, n / max(stages[name], 1e-9)) for name, n in samples.items())),
+        ('config', config.__dict__),
+    ])
+    print("Benchmark of {} chunks ({} records) at commit {}{}".format(n_chunks, len(arr[0]), commit, " (modified)" if dirty else ""))
+    for name, seconds in stages.items():
+        print("  {:<18}{:10.3f}s".format(name, seconds))
+    for name, rate in report['samples_per_sec'].items():
+        print("  {:<18}{:10.1f} samples/s".format(name, rate))
+    with open(config.BENCHMARK_FILE, "w") as f:
+        json.dump(report, f, indent=4)
+    print("Wrote {}".format(config.BENCHMARK_FILE))
+
+def load_and_train_lstm():
+    if results.shards:
+        training_arr, validation_arr, i_map, o_map = load_sharded_corpus(results.shards)
+    else:
+        training_arr, validation_arr, i_map, o_map = load_and_process_arrays()
     autoencoder, encoder = train_encoder(training_arr, validation_arr, i_map[0])
     train_lstm(encoder, training_arr, validation_arr, i_map, o_map)
 
@@ -365,4 +1320,15 @@ if __name__ == "__main__":
     print(json.dumps(config.__dict__, indent=4))
 
     results = parse_args()
-    load_and_train_lstm()
+    if results.benchmark > 0:
+        benchmark(results.benchmark)
+    elif results.distill:
+        distill()
+    elif results.export:
+        export_frozen()
+    elif results.fuse:
+        export_fused()
+    elif results.quantize:
+        evaluate_quantized(results.quantize)
+    else:
+        load_and_train_lstm()
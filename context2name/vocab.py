@@ -0,0 +1,156 @@
+import json
+import os
+import pickle
+import zlib
+import numpy as np
+
+# Compact vocabulary format. A vocabulary is a directory of .npy files and a
+# meta.json, memory-mapped when loaded, so that the pages are shared by all the
+# processes using it instead of every process unpickling its own dicts:
+#   strings.npy : uint8, the UTF-8 bytes of all words, in id order
+#   offsets.npy : int64, (size + 1,), word i is strings[offsets[i]:offsets[i+1]]
+#   index.npy   : int32, open addressing hash table of the ids keyed by the
+#                 crc32 of the UTF-8 word, with linear probing. -1 is an empty slot
+
+VOCAB_ARRAYS = ['strings', 'offsets', 'index']
+
+class Vocab:
+    # Maps words to ids and back. Acts as the word2index dict of the
+    # (size, word2index, index2word) tuples of get_word2index, see as_map
+
+    def __init__(self, strings, offsets, index):
+        self.strings = strings
+        self.offsets = offsets
+        self.index = index
+        self.mask = len(index) - 1
+        # Memoryviews index the (memory-mapped) arrays without creating NumPy scalars
+        self.blob = memoryview(strings)
+        self.starts = memoryview(offsets).cast('B').cast('q')
+        self.slots = memoryview(index).cast('B').cast('i')
+        # Unused ids are the empty words other than the one in the index, if any
+        self.empty_id = self.get("")
+
+    @staticmethod
+    def build(words):
+        # words : the words in id order. None marks an unused id (get_word2index
+        # skips the id counted for PAD or UNK when they are frequent tokens); it is
+        # stored as an empty word and left out of the hash index, see has_id
+        encoded = [b"" if w is None else w.encode('utf-8') for w in words]
+        offsets = np.zeros([len(encoded) + 1], dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        strings = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+        size = 1
+        while size < 2 * len(encoded):
+            size *= 2
+        index = np.full([size], -1, dtype=np.int32)
+        for i, (w, b) in enumerate(zip(words, encoded)):
+            if w is None:
+                continue
+            slot = zlib.crc32(b) & (size - 1)
+            while index[slot] >= 0:
+                slot = (slot + 1) & (size - 1)
+            index[slot] = i
+        return Vocab(strings, offsets, index)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in VOCAB_ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({'size' : len(self), 'index_size' : len(self.index)}, f, indent=4)
+
+    @staticmethod
+    def load(path, mmap=True):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mode) for name in VOCAB_ARRAYS]
+        vocab = Vocab(*arrays)
+        if len(vocab) != meta['size'] or len(vocab.index) != meta['index_size']:
+            raise ValueError("{} does not match its meta.json".format(path))
+        return vocab
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def has_id(self, i):
+        return 0 <= i < len(self) and (self.starts[i] != self.starts[i+1] or i == self.empty_id)
+
+    def word(self, i):
+        return str(self.blob[self.starts[i]:self.starts[i+1]], 'utf-8')
+
+    def get(self, word, default=None):
+        b = word.encode('utf-8')
+        slot = zlib.crc32(b) & self.mask
+        while True:
+            i = self.slots[slot]
+            if i < 0:
+                return default
+            if self.blob[self.starts[i]:self.starts[i+1]] == b:
+                return i
+            slot = (slot + 1) & self.mask
+
+    def __getitem__(self, word):
+        i = self.get(word)
+        if i is None:
+            raise KeyError(word)
+        return i
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def lookup(self, words, default):
+        # Ids of a list of words as an int32 array, default for unknown words
+        return np.fromiter((self.get(w, default) for w in words), dtype=np.int32, count=len(words))
+
+    def words(self, ids, default=None):
+        # Words of a sequence of ids, default for unused ids and ids out of range
+        return [self.word(i) if self.has_id(i) else default for i in ids]
+
+    def as_map(self):
+        return (len(self), self, IndexView(self))
+
+class IndexView:
+    # The index2word side of a Vocab
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def get(self, i, default=None):
+        return self.vocab.word(i) if self.vocab.has_id(i) else default
+
+    def __getitem__(self, i):
+        if not self.vocab.has_id(i):
+            raise KeyError(i)
+        return self.vocab.word(i)
+
+    def words(self, ids, default=None):
+        return self.vocab.words(ids, default)
+
+def build_map(word_map):
+    # Vocab of a (size, word2index, index2word) tuple of get_word2index. The ids
+    # need not be contiguous, missing ones become unused ids
+    size, word2index, index2word = word_map
+    vocab = Vocab.build([index2word.get(i) for i in range(size)])
+    if len(vocab) != size or any(vocab.get(w) != i for w, i in word2index.items()):
+        raise ValueError("Vocabulary of {} words does not match its word2index".format(size))
+    return vocab
+
+def save_map(path, word_map):
+    # Writes a (size, word2index, index2word) tuple of get_word2index
+    build_map(word_map).save(path)
+
+def load_map(path):
+    # Returns the (size, word2index, index2word) tuple of a vocabulary directory,
+    # or of a pickle written by earlier versions of training.py (found as
+    # path.pkl when path does not exist)
+    if os.path.isdir(path):
+        return Vocab.load(path).as_map()
+    if not os.path.exists(path) and os.path.exists(path + ".pkl"):
+        path = path + ".pkl"
+    with open(path, 'rb') as f:
+        word_map = pickle.load(f)
+    return build_map(word_map).as_map()